@@ -1,29 +1,636 @@
-import os, re, json, base64, boto3, traceback
+import os, io, re, json, time, uuid, fcntl, base64, struct, random, hashlib, threading, boto3, traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+from crashtruth_s3 import INDEX_ENTRY_BYTES, IndexedJSONLWriter, index_key  # bundled next to this file
+try:
+    from PIL import Image  # optional (Lambda layer); dedupe and resizing are off without it
+except ImportError:
+    Image = None
 
 # ✅ Configuration
-SM_ENDPOINT    = "huggingface-pytorch-inference-2025-10-26-02-21-39-496"
+DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "sagemaker").lower()  # sagemaker | local | fake
+SM_ENDPOINT    = os.environ.get("SM_ENDPOINT", "huggingface-pytorch-inference-2025-10-26-02-21-39-496")
+# several endpoints (or "endpoint:variant" production variants) → least-loaded routing
+SM_ENDPOINTS   = [e.strip() for e in os.environ.get("SM_ENDPOINTS", SM_ENDPOINT).split(",") if e.strip()]
+EWMA_ALPHA     = float(os.environ.get("EWMA_ALPHA", "0.3"))
+LOCAL_MODEL    = os.environ.get("LOCAL_MODEL", "hustvl/yolos-small")
 FRAMES_BUCKET  = os.environ.get("FRAMES_BUCKET", "crashtruth-frames")
 REPORTS_BUCKET = os.environ.get("REPORTS_BUCKET", "crashtruth-reports")
 MIN_FRAMES     = int(os.environ.get("MIN_FRAMES", "8"))
+CONCURRENCY    = max(1, int(os.environ.get("INFER_CONCURRENCY", "8")))  # 1 = sequential
+BATCH_SIZE     = max(1, int(os.environ.get("INFER_BATCH_SIZE", "8")))   # max frames per endpoint call
+# SageMaker real-time requests are capped at 6 MB; stay under it with headroom
+MAX_PAYLOAD_BYTES = int(os.environ.get("MAX_PAYLOAD_BYTES", str(5 * 1024 * 1024)))
+# "binary": raw JPEG bytes (image/jpeg, or BATCH_CONTENT_TYPE for several frames);
+# "json": legacy {"inputs": base64}. Binary falls back to JSON if the endpoint rejects it.
+TRANSPORT      = os.environ.get("INFER_TRANSPORT", "binary").lower()
+BATCH_CONTENT_TYPE = "application/x-image-batch"  # [4-byte big-endian length][jpeg] ... (see yolo.ipynb)
 
-# ✅ Clients
-s3 = boto3.client("s3")
-runtime = boto3.client("sagemaker-runtime")
+# resilience: AIMD in-flight limit, jittered retries, circuit breaker per endpoint
+INFER_RETRIES        = int(os.environ.get("INFER_RETRIES", "4"))
+RETRY_BASE_S         = float(os.environ.get("RETRY_BASE_S", "0.25"))
+RETRY_CAP_S          = float(os.environ.get("RETRY_CAP_S", "8"))
+LATENCY_TARGET_MS    = float(os.environ.get("LATENCY_TARGET_MS", "5000"))  # slower calls count as congestion
+BREAKER_FAILURES     = int(os.environ.get("BREAKER_FAILURES", "5"))        # consecutive failures → open
+BREAKER_COOLDOWN_S   = float(os.environ.get("BREAKER_COOLDOWN_S", "30"))
+BREAKER_MAX_WAIT_S   = float(os.environ.get("BREAKER_MAX_WAIT_S", "120"))  # per invocation, then record failures
 
-def invoke_model(b64):
-    """Invoke the SageMaker endpoint with base64 image input"""
-    try:
-        response = runtime.invoke_endpoint(
-            EndpointName=SM_ENDPOINT,
-            ContentType="application/json",
-            Body=json.dumps({"inputs": b64})
-        )
-        result = response["Body"].read()
-        return json.loads(result.decode("utf-8"))
-    except Exception as e:
-        print(f"❌ SageMaker call failed: {str(e)}")
-        traceback.print_exc()
-        return []
+# global rate limit shared by every invocation hitting the same endpoint (token bucket,
+# split fairly between the videos currently in flight)
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "none").lower()  # none | memory | file | dynamodb
+RATE_LIMIT_TABLE = os.environ.get("RATE_LIMIT_TABLE", "crashtruth-rate-limits")  # partition key "pk" (S)
+RATE_LIMIT_DIR   = os.environ.get("RATE_LIMIT_DIR", "/tmp")
+RATE_LIMIT_RPS   = float(os.environ.get("RATE_LIMIT_RPS", "4"))     # requests/s per endpoint
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "8"))
+RATE_LIMITS      = json.loads(os.environ.get("RATE_LIMITS", "{}"))  # {"<endpoint>": {"rps": 6, "burst": 12}}
+VIDEO_IDLE_S     = float(os.environ.get("VIDEO_IDLE_S", "30"))      # drop a video's share after this
+
+# detection cache: frame content hash + endpoint/model version → detections
+MODEL_VERSION    = os.environ.get("MODEL_VERSION", "hustvl/yolos-small")
+CACHE_BACKEND    = os.environ.get("CACHE_BACKEND", "local").lower()   # local | s3 | none
+CACHE_DIR        = os.environ.get("CACHE_DIR", "/tmp/detections-cache")
+CACHE_MAX_BYTES  = int(os.environ.get("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # local disk budget
+CACHE_BUCKET     = os.environ.get("CACHE_BUCKET", REPORTS_BUCKET)
+CACHE_PREFIX     = os.environ.get("CACHE_PREFIX", "_cache/")  # expire with an S3 lifecycle rule
+CACHE_MEM_ENTRIES = int(os.environ.get("CACHE_MEM_ENTRIES", "2048"))  # in-memory LRU in front of S3
+
+# near-duplicate skipping: frames whose 64-bit dHash is within this Hamming distance of the
+# last inferred frame reuse its detections (-1 disables)
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE", "2"))
+
+# client-side downscale to the YOLOS working resolution (shortest edge 800, longest ≤ 1333);
+# the model resizes to this anyway, so larger frames only cost bytes on the wire (0 disables)
+RESIZE_SHORT_EDGE = int(os.environ.get("RESIZE_SHORT_EDGE", "800"))
+RESIZE_LONG_EDGE  = int(os.environ.get("RESIZE_LONG_EDGE", "1333"))
+RESIZE_QUALITY    = int(os.environ.get("RESIZE_QUALITY", "85"))
+
+# what is persisted per frame: filters run on the way out, so cached detections stay complete
+DETECT_LABELS    = {l for l in os.environ.get("DETECT_LABELS", "").split(",") if l}  # empty = every label
+DETECT_MIN_SCORE = float(os.environ.get("DETECT_MIN_SCORE", "0"))
+DETECT_TOP_K     = int(os.environ.get("DETECT_TOP_K", "0"))        # per frame, 0 = unlimited
+DETECT_NMS_IOU   = float(os.environ.get("DETECT_NMS_IOU", "0"))    # same-label NMS, 0 = off
+RECORD_FORMAT    = os.environ.get("RECORD_FORMAT", "verbose").lower()  # verbose | compact
+SCORE_DECIMALS   = int(os.environ.get("SCORE_DECIMALS", "3"))
+
+# sparse detection: run the model every KEYFRAME_MAX_K frames and interpolate boxes in between;
+# a gap is split (down to KEYFRAME_MIN_K) while boxes move fast, appear/vanish or TTC is low
+FPS               = float(os.environ.get("FPS", "5"))
+KEYFRAME_MAX_K    = max(1, int(os.environ.get("KEYFRAME_MAX_K", "1")))   # 1 = detect every frame
+KEYFRAME_MIN_K    = max(1, int(os.environ.get("KEYFRAME_MIN_K", "1")))
+KEYFRAME_MOTION_PX = float(os.environ.get("KEYFRAME_MOTION_PX", "12"))   # center px per frame
+KEYFRAME_TTC_S    = float(os.environ.get("KEYFRAME_TTC_S", "4.0"))
+KEYFRAME_LABELS   = set(os.environ.get("KEYFRAME_LABELS", "car").split(","))
+
+# single-flight claim: one marker object per video in the reports bucket
+CLAIM_NAME     = "_claim.json"
+LEASE_SECONDS  = int(os.environ.get("LEASE_SECONDS", "900"))       # = max Lambda lifetime
+SETTLE_SECONDS = float(os.environ.get("SETTLE_SECONDS", "10"))     # wait between frame counts
+SETTLE_MAX_SECONDS = float(os.environ.get("SETTLE_MAX_SECONDS", "180"))
+SETTLE_RETRIES = int(os.environ.get("SETTLE_RETRIES", "5"))  # re-invocations while frames keep arriving
+
+# checkpointing: partial detections + cursor survive timeouts and crashes
+CHECKPOINT_NAME   = "_checkpoint.json"
+CHECKPOINT_FRAMES = max(1, int(os.environ.get("CHECKPOINT_FRAMES", "100")))  # frames per checkpoint
+TIME_MARGIN_MS    = int(os.environ.get("TIME_MARGIN_MS", "60000"))  # stop & re-invoke below this
+WINDOW_MAX_FRAMES = int(os.environ.get("WINDOW_MAX_FRAMES", "500"))  # per window_handler request
+# incremental publishing: ordered <video>/chunks/NNNNNN.jsonl pieces + chunks/_complete.json,
+# so Tracker can start before the whole video is done (0 = only detections_all.jsonl)
+PUBLISH_CHUNK_FRAMES = int(os.environ.get("PUBLISH_CHUNK_FRAMES", "0"))
+CHUNK_PREFIX      = "chunks/"
+COMPLETE_NAME     = "_complete.json"
+# frames downloaded (and hashed) ahead of the window being inferred; bounds memory
+PREFETCH_FRAMES   = max(CHECKPOINT_FRAMES, int(os.environ.get("PREFETCH_FRAMES", str(CHECKPOINT_FRAMES))))
+PREFETCH_WORKERS  = max(1, int(os.environ.get("PREFETCH_WORKERS", str(CONCURRENCY))))
+
+# async inference: submit batches to an async endpoint, a collector assembles the JSONL
+INFER_MODE       = os.environ.get("INFER_MODE", "sync").lower()        # sync | async
+ASYNC_QUEUE      = os.environ.get("ASYNC_QUEUE", "sagemaker").lower()  # sagemaker | local (stand-in)
+ASYNC_ENDPOINT   = os.environ.get("ASYNC_ENDPOINT", SM_ENDPOINT)
+ASYNC_BUCKET     = os.environ.get("ASYNC_BUCKET", REPORTS_BUCKET)     # inputs under <video>/_async/in/
+ASYNC_PREFIX     = "_async/"
+ASYNC_BATCH_SIZE = max(1, int(os.environ.get("ASYNC_BATCH_SIZE", "32")))  # frames per async request
+ASYNC_LEASE_SECONDS = int(os.environ.get("ASYNC_LEASE_SECONDS", str(6 * 3600)))  # claim while outputs land
+LANDED_NAME      = "_async_landed.json"  # numbers of the async requests whose output/failure has landed
+
+# ✅ Clients (pool sized so every worker gets its own connection)
+pool_cfg = Config(max_pool_connections=max(10, CONCURRENCY + PREFETCH_WORKERS + 2))
+s3 = boto3.client("s3", config=pool_cfg)
+# retries for the endpoint are ours (backoff + breaker + AIMD), so botocore makes a single attempt
+runtime = boto3.client("sagemaker-runtime", config=pool_cfg.merge(Config(retries={"max_attempts": 1, "mode": "standard"})))
+lambda_client = boto3.client("lambda")
+
+class UnsupportedTransport(Exception):
+    """The endpoint does not understand the binary content types"""
+
+class EndpointUnavailable(Exception):
+    """The circuit breaker is open or retries are exhausted"""
+
+THROTTLE_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailable",
+                  "ServiceUnavailableException", "SlowDown", "RequestLimitExceeded"}
+
+def classify_error(e):
+    """→ "throttle" (back off + shrink concurrency), "server" (retry) or "client" (don't retry)"""
+    if isinstance(e, BotoCoreError):
+        return "server"  # connection resets, read timeouts
+    if isinstance(e, ClientError):
+        err, meta = e.response.get("Error", {}), e.response.get("ResponseMetadata", {})
+        status = meta.get("HTTPStatusCode") or 0
+        original = e.response.get("OriginalStatusCode") or 0
+        if err.get("Code") in THROTTLE_CODES or 429 in (status, original):
+            return "throttle"
+        if status >= 500 or original >= 500 or err.get("Code") in ("InternalFailure", "ModelNotReadyException"):
+            return "server"
+    return "client"
+
+class AIMDLimiter:
+    """
+    Adaptive cap on in-flight endpoint calls: +1/limit per healthy response (additive increase),
+    halved on throttling or latency above the target (multiplicative decrease, at most once per
+    target interval so one burst of errors doesn't collapse it to the floor).
+    """
+
+    def __init__(self, limit, min_limit=1, max_limit=None, target_ms=LATENCY_TARGET_MS):
+        self.limit, self.min_limit = float(limit), min_limit
+        self.max_limit = max_limit or limit
+        self.target = target_ms / 1000.0
+        self.inflight, self.last_decrease = 0, 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, latency=None, throttled=False):
+        with self.cond:
+            self.inflight -= 1
+            now = time.time()
+            if throttled or (latency is not None and latency > self.target):
+                if now - self.last_decrease >= self.target:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease = now
+                    print(f"📉 Endpoint congested → in-flight limit {int(self.limit)}")
+            elif latency is not None:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+class CircuitBreaker:
+    """Opens after BREAKER_FAILURES consecutive failures; after the cooldown one probe call may pass"""
+
+    def __init__(self, name, threshold=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN_S):
+        self.name, self.threshold, self.cooldown = name, threshold, cooldown
+        self.failures, self.opened_at, self.probing = 0, None, False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def ready(self):
+        """True when a call would be let through (closed, or cooled down with no probe in flight)"""
+        return self.opened_at is None or (time.time() - self.opened_at >= self.cooldown and not self.probing)
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown and not self.probing:
+                self.probing = threading.get_ident()  # half-open: exactly one probe, owned by this thread
+                return True
+            return False
+
+    def end_probe(self):
+        """Release the half-open slot if this thread's probe ended without a verdict (e.g. a 4xx)"""
+        with self.lock:
+            if self.probing == threading.get_ident():
+                self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print(f"✅ Circuit closed for {self.name}")
+            self.failures, self.opened_at, self.probing = 0, None, False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                print(f"🚧 Circuit open for {self.name} ({self.failures} consecutive failures)")
+                self.opened_at, self.probing = time.time(), False
+
+def backoff(attempt):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(RETRY_CAP_S, RETRY_BASE_S * (2 ** attempt)))
+
+class MemoryRateStore:
+    """In-process stand-in (tests, single container)"""
+
+    def __init__(self):
+        self.items, self.lock = {}, threading.Lock()
+
+    def update(self, key, fn):
+        """Atomically state → fn(state) → (new state, result); returns result"""
+        with self.lock:
+            state, result = fn(self.items.get(key, {}))
+            self.items[key] = state
+            return result
+
+class FileRateStore:
+    """Local-file stand-in shared by processes on one host (flock around a JSON file)"""
+
+    def __init__(self, directory=RATE_LIMIT_DIR):
+        self.dir = directory
+
+    def update(self, key, fn):
+        path = os.path.join(self.dir, f"ratelimit-{hashlib.sha1(key.encode()).hexdigest()[:16]}.json")
+        with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state, result = fn(json.loads(raw) if raw else {})
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()  # before the lock is released
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+class DynamoRateStore:
+    """One item per endpoint, updated with optimistic concurrency on a version number"""
+
+    def __init__(self, table=RATE_LIMIT_TABLE):
+        self.table, self.client = table, boto3.client("dynamodb")
+
+    def update(self, key, fn):
+        while True:
+            item = self.client.get_item(TableName=self.table, Key={"pk": {"S": key}},
+                                        ConsistentRead=True).get("Item")
+            version = int(item["version"]["N"]) if item else 0
+            state, result = fn(json.loads(item["state"]["S"]) if item else {})
+            try:
+                self.client.put_item(
+                    TableName=self.table,
+                    Item={"pk": {"S": key}, "state": {"S": json.dumps(state)}, "version": {"N": str(version + 1)}},
+                    ConditionExpression="attribute_not_exists(pk) OR version = :v",
+                    ExpressionAttributeValues={":v": {"N": str(version)}})
+                return result
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                    raise
+                time.sleep(random.uniform(0, 0.05))  # lost the race → re-read
+
+class GlobalRateLimiter:
+    """
+    Token bucket per endpoint kept in a shared store. The endpoint's rate is divided evenly
+    between the videos seen in the last VIDEO_IDLE_S, each with its own sub-bucket, so a long
+    video can't starve a short one and the sum stays at the endpoint's capacity.
+    """
+
+    def __init__(self, store, endpoint):
+        limits = RATE_LIMITS.get(endpoint, {})
+        self.store, self.key = store, f"rate#{endpoint}"
+        self.rps = float(limits.get("rps", RATE_LIMIT_RPS))
+        self.burst = float(limits.get("burst", RATE_LIMIT_BURST))
+        self.video = "default"  # set per invocation by lambda_handler
+
+    def _take(self, video, cost, now):
+        def fn(state):
+            videos = {v: t for v, t in state.get("videos", {}).items() if now - t < VIDEO_IDLE_S}
+            videos[video] = now
+            share = len(videos)
+            rate, burst = self.rps / share, max(1.0, self.burst / share)
+            buckets = {v: b for v, b in state.get("buckets", {}).items() if v in videos}
+            b = buckets.get(video, {"tokens": burst, "ts": now})
+            tokens = min(burst, b["tokens"] + (now - b["ts"]) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            buckets[video] = {"tokens": tokens - cost if not wait else tokens, "ts": now}
+            return {"videos": videos, "buckets": buckets}, wait
+        return fn
+
+    def acquire(self, cost=1.0):
+        """Block until this video may send `cost` more requests"""
+        while True:
+            wait = self.store.update(self.key, self._take(self.video, cost, time.time()))
+            if not wait:
+                return
+            time.sleep(min(wait, 1.0))
+
+    def leave(self):
+        """Give this video's share back as soon as it is done"""
+        def fn(state):
+            state.get("videos", {}).pop(self.video, None)
+            state.get("buckets", {}).pop(self.video, None)
+            return state, None
+        self.store.update(self.key, fn)
+
+def make_rate_store(kind=RATE_LIMIT_STORE):
+    if kind == "dynamodb":
+        return DynamoRateStore()
+    if kind == "file":
+        return FileRateStore()
+    if kind == "memory":
+        return MemoryRateStore()
+    return None
+
+rate_store = make_rate_store()
+
+# how an endpoint says it can't decode a content type: code/inference.py in yolo.ipynb, and the
+# HF inference toolkit's UnsupportedFormatError (HTTP 415); the runtime wraps both in a ModelError
+CONTENT_TYPE_REJECTIONS = ("415: content type {} not supported", "content type {} is not supported by this framework")
+
+def _rejected_content_type(e: ClientError, content_type: str):
+    err = e.response.get("Error", {})
+    msg = str(err.get("Message", "")).lower()
+    return err.get("Code") in ("ModelError", "ValidationError") and (
+        "received client error (415)" in msg
+        or any(p.format(content_type.lower()) in msg for p in CONTENT_TYPE_REJECTIONS))
+
+def pack_payloads(items, limit=MAX_PAYLOAD_BYTES, max_items=BATCH_SIZE, item_overhead=4, base_overhead=14):
+    """
+    Split frames into request-sized chunks (≤ max_items each, body ≤ limit bytes).
+    Overheads default to the JSON envelope: '{"inputs": []}' plus quotes/separator per item;
+    the binary batch format costs a 4-byte length prefix per item and nothing else.
+    """
+    chunks, cur, cur_bytes = [], [], base_overhead
+    for item in items:
+        size = len(item) + item_overhead
+        if cur and (len(cur) >= max_items or cur_bytes + size > limit):
+            chunks.append(cur)
+            cur, cur_bytes = [], base_overhead
+        cur.append(item)
+        cur_bytes += size
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+class SageMakerDetector:
+    """
+    The YOLOS real-time endpoint from yolo.ipynb.
+    detect() returns one detection list per image, or None for an image whose call failed.
+    """
+
+    def __init__(self, endpoint=SM_ENDPOINT, transport=TRANSPORT, variant=None):
+        self.endpoint, self.transport, self.variant = endpoint, transport, variant
+        self.name = f"{endpoint}:{variant}" if variant else endpoint
+        self.json_fallback = threading.Event()  # set once binary transport is rejected
+        self.limiter = AIMDLimiter(CONCURRENCY)
+        self.breaker = CircuitBreaker(self.name)
+        self.rate = GlobalRateLimiter(rate_store, self.name) if rate_store else None
+        self.ewma = None  # smoothed seconds per successful call, for routing
+
+    @property
+    def scope(self):
+        return f"sagemaker:{self.name}"
+
+    def ready(self):
+        return self.breaker.ready()
+
+    def bind_video(self, video_id):
+        if self.rate:
+            self.rate.video = video_id  # fair share of the endpoint's global rate
+
+    def release_video(self):
+        if self.rate:
+            self.rate.leave()
+
+    def invoke(self, content_type, body):
+        """
+        One endpoint request with retries → response bytes.
+        Throttling/5xx/connection errors are retried with jittered backoff and feed the AIMD
+        limiter and breaker; client errors (4xx) are raised at once.
+        """
+        if not self.breaker.allow():
+            raise EndpointUnavailable(f"circuit open for {self.endpoint}")
+        try:
+            return self._invoke(content_type, body)
+        finally:
+            self.breaker.end_probe()
+
+    def _invoke(self, content_type, body):
+        for attempt in range(INFER_RETRIES + 1):
+            if self.rate:
+                self.rate.acquire()
+            self.limiter.acquire()
+            started = time.time()
+            try:
+                args = {"TargetVariant": self.variant} if self.variant else {}
+                response = runtime.invoke_endpoint(EndpointName=self.endpoint, ContentType=content_type,
+                                                   Body=body, **args)
+                result = response["Body"].read()
+            except Exception as e:
+                kind = classify_error(e)
+                self.limiter.release(throttled=kind == "throttle")
+                if kind == "client":
+                    raise
+                self.breaker.record_failure()
+                if attempt == INFER_RETRIES or self.breaker.is_open:
+                    raise EndpointUnavailable(f"{kind} error after {attempt + 1} attempts: {str(e)}")
+                time.sleep(backoff(attempt))
+                continue
+            latency = time.time() - started
+            self.limiter.release(latency=latency)
+            self.breaker.record_success()
+            self.ewma = latency if self.ewma is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma
+            return result
+
+    def invoke_json(self, b64):
+        """Invoke the endpoint with one base64 image (None if the call failed)"""
+        try:
+            result = self.invoke("application/json", json.dumps({"inputs": b64}))
+            return json.loads(result.decode("utf-8"))
+        except Exception as e:
+            print(f"❌ SageMaker call failed: {str(e)}")
+            traceback.print_exc()
+            return None
+
+    def invoke_json_batch(self, b64s):
+        """Invoke the endpoint with several base64 images in one request → one detection list per image"""
+        if len(b64s) == 1:
+            return [self.invoke_json(b64s[0])]
+        try:
+            result = json.loads(self.invoke("application/json", json.dumps({"inputs": b64s})).decode("utf-8"))
+        except Exception as e:
+            print(f"❌ SageMaker batch call failed ({len(b64s)} frames): {str(e)}")
+            traceback.print_exc()
+            return [None for _ in b64s]
+        # the HF pipeline answers a list input with a list of per-image detection lists
+        if isinstance(result, list) and len(result) == len(b64s) and all(isinstance(r, list) for r in result):
+            return result
+        print(f"⚠️ Unexpected batch response shape for {len(b64s)} frames → falling back to single calls")
+        return [self.invoke_json(b) for b in b64s]
+
+    def invoke_binary(self, images):
+        """Invoke the endpoint with raw JPEG bytes → one detection list per image (raises UnsupportedTransport)"""
+        if len(images) == 1:
+            content_type, body = "image/jpeg", images[0]
+        else:
+            content_type = BATCH_CONTENT_TYPE
+            body = b"".join(struct.pack(">I", len(img)) + img for img in images)
+        try:
+            result = json.loads(self.invoke(content_type, body).decode("utf-8"))
+        except ClientError as e:
+            if _rejected_content_type(e, content_type):
+                raise UnsupportedTransport(str(e))
+            print(f"❌ SageMaker binary call failed ({len(images)} frames): {str(e)}")
+            traceback.print_exc()
+            return [None for _ in images]
+        except Exception as e:
+            print(f"❌ SageMaker binary call failed ({len(images)} frames): {str(e)}")
+            traceback.print_exc()
+            return [None for _ in images]
+        if len(images) == 1:
+            return [result]
+        if isinstance(result, list) and len(result) == len(images) and all(isinstance(r, list) for r in result):
+            return result
+        print(f"⚠️ Unexpected batch response shape for {len(images)} frames → falling back to single calls")
+        return [self.invoke_binary([img])[0] for img in images]
+
+    def detect(self, images):
+        """Raw JPEG bytes → one detection list per image, using the configured transport"""
+        if self.transport == "binary" and not self.json_fallback.is_set():
+            try:
+                return [d for chunk in pack_payloads(images, base_overhead=0)
+                        for d in self.invoke_binary(chunk)]
+            except UnsupportedTransport as e:
+                if not self.json_fallback.is_set():
+                    print(f"⚠️ Endpoint rejected binary input → falling back to JSON/base64 ({e})")
+                self.json_fallback.set()
+        b64s = [base64.b64encode(img).decode("utf-8") for img in images]
+        return [d for chunk in pack_payloads(b64s) for d in self.invoke_json_batch(chunk)]
+
+class LocalDetector:
+    """
+    The same YOLOS model run in-process on CPU through transformers, for batch/offline
+    reprocessing without endpoint cost. LOCAL_MODEL may be a hub id or a local directory.
+    """
+
+    def __init__(self, model=LOCAL_MODEL):
+        from transformers import pipeline  # heavy; only needed for this backend
+        if Image is None:
+            raise RuntimeError("the local detector needs Pillow")
+        self.model = model
+        self.pipe = pipeline("object-detection", model=model, device=-1)
+        self.lock = threading.Lock()  # one forward pass at a time; torch already uses every core
+
+    @property
+    def scope(self):
+        return f"local:{self.model}"
+
+    def ready(self):
+        return True
+
+    def bind_video(self, video_id):
+        pass
+
+    def release_video(self):
+        pass
+
+    def detect(self, images):
+        results = [None] * len(images)
+        decoded = []
+        for i, img in enumerate(images):
+            try:
+                decoded.append((i, Image.open(io.BytesIO(img)).convert("RGB")))
+            except Exception as e:
+                print(f"❌ Could not decode frame: {str(e)}")
+        if not decoded:
+            return results
+        try:
+            with self.lock:
+                out = self.pipe([im for _, im in decoded])
+        except Exception as e:
+            print(f"❌ Local inference failed ({len(decoded)} frames): {str(e)}")
+            traceback.print_exc()
+            return results
+        for (i, _), dets in zip(decoded, out):
+            results[i] = [{"score": float(d["score"]), "label": d["label"],
+                           "box": {k: int(v) for k, v in d["box"].items()}} for d in dets]
+        return results
+
+class FakeDetector:
+    """Deterministic detections derived from the image bytes, for tests and dry runs"""
+
+    scope = "fake"
+
+    def ready(self):
+        return True
+
+    def bind_video(self, video_id):
+        pass
+
+    def release_video(self):
+        pass
+
+    def detect(self, images):
+        out = []
+        for img in images:
+            h = hashlib.sha256(img).digest()
+            dets = []
+            for n in range(h[0] % 4):
+                x, y, w = h[1 + 3 * n] * 4, 100 + h[2 + 3 * n], 40 + h[3 + 3 * n] // 2
+                dets.append({"score": round(0.5 + h[20 + n] / 512, 4), "label": "car",
+                             "box": {"xmin": x, "ymin": y, "xmax": x + w, "ymax": y + w * 3 // 4}})
+            out.append(dets)
+        return out
+
+class EndpointPool:
+    """
+    Several SageMaker endpoints/variants behind one detect(). Each batch goes to the healthy
+    target with the lowest expected wait, EWMA latency × (in-flight + 1); targets whose breaker
+    is open are drained until their probe succeeds. Frames that fail on one target are retried
+    once on the next best, so a blue/green swap or a dying instance doesn't lose frames.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.lock = threading.Lock()
+
+    @property
+    def scope(self):
+        return "sagemaker:" + ",".join(sorted(t.name for t in self.targets))
+
+    def ready(self):
+        return any(t.ready() for t in self.targets)
+
+    def bind_video(self, video_id):
+        for t in self.targets:
+            t.bind_video(video_id)
+
+    def release_video(self):
+        for t in self.targets:
+            t.release_video()
+
+    def ranked(self):
+        with self.lock:
+            healthy = [t for t in self.targets if t.ready()]
+            # unknown latency sorts first so new/recovered targets get sampled
+            return sorted(healthy, key=lambda t: ((t.ewma or 0.0) * (t.limiter.inflight + 1), t.limiter.inflight))
+
+    def detect(self, images):
+        results = [None] * len(images)
+        pending = list(range(len(images)))
+        for target in self.ranked()[:2]:
+            for i, dets in zip(pending, target.detect([images[i] for i in pending])):
+                results[i] = dets
+            pending = [i for i in pending if results[i] is None]
+            if not pending:
+                break
+        return results
+
+def make_detector(backend=DETECTOR_BACKEND):
+    if backend == "local":
+        return LocalDetector()
+    if backend == "fake":
+        return FakeDetector()
+    targets = [SageMakerDetector(t.partition(":")[0], variant=t.partition(":")[2] or None) for t in SM_ENDPOINTS]
+    return targets[0] if len(targets) == 1 else EndpointPool(targets)
+
+detector = make_detector()
 
 def list_frames(prefix: str):
     """List all frame keys in crashtruth-frames/<video_id>/"""
@@ -42,18 +649,1006 @@ def list_frames(prefix: str):
     print(f"✅ Total frames found: {len(keys)}")
     return sorted(keys)
 
-def lambda_handler(event, _):
+def _claim_body(owner: str, status: str, stats=None, lease=LEASE_SECONDS):
+    return json.dumps({"owner": owner, "status": status, "stats": stats or {},
+                       "expires_at": time.time() + lease}).encode("utf-8")
+
+def _precondition_failed(e: ClientError):
+    return e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+
+def claim_video(prefix: str, owner: str):
+    """
+    Try to become the single worker for a video.
+    Uses a conditional create (If-None-Match: *) on <prefix>_claim.json, so exactly one
+    trigger wins; an expired lease can be taken over with If-Match on its ETag.
+    Returns (claimed, status_of_existing_claim).
+    """
+    key = f"{prefix}{CLAIM_NAME}"
+    try:
+        s3.put_object(Bucket=REPORTS_BUCKET, Key=key, Body=_claim_body(owner, "running"),
+                      ContentType="application/json", IfNoneMatch="*")
+        return True, None
+    except ClientError as e:
+        if not _precondition_failed(e):
+            raise
+
+    claim, etag = read_claim(prefix)
+    if claim is None:
+        # claim vanished between the two calls (released) → let the next trigger retry
+        return False, "released"
+
+    if claim.get("status") == "done":
+        return False, "done"
+    # our own lease (continuation or async retry) renews; a stale lease from a crashed worker is taken over
+    if claim.get("owner") != owner and claim.get("expires_at", 0) > time.time():
+        return False, claim.get("status")
+
+    try:
+        s3.put_object(Bucket=REPORTS_BUCKET, Key=key, Body=_claim_body(owner, "running"),
+                      ContentType="application/json", IfMatch=etag)
+        if claim.get("owner") != owner:
+            print(f"♻️ Took over expired claim from {claim.get('owner')}")
+        return True, None
+    except ClientError as e:
+        if not _precondition_failed(e):
+            raise
+        return False, "running"
+
+def read_claim(prefix: str):
+    """→ (claim, ETag), or (None, None) if there is no claim"""
+    try:
+        cur = s3.get_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CLAIM_NAME}")
+    except ClientError:
+        return None, None
+    return json.loads(cur["Body"].read()), cur["ETag"]
+
+def finish_claim(prefix: str, owner: str, stats=None):
+    """Mark the video as processed (with its run stats) so later triggers exit on the claim alone"""
+    s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CLAIM_NAME}",
+                  Body=_claim_body(owner, "done", stats), ContentType="application/json")
+
+def release_claim(prefix: str):
+    """Drop the claim so a later trigger can pick the video up again"""
+    s3.delete_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CLAIM_NAME}")
+
+def wait_for_frames(prefix: str):
+    """
+    Poll the frame listing until MediaConvert stops adding frames (count stable across
+    SETTLE_SECONDS) → the frame keys, or None if they are still arriving after SETTLE_MAX_SECONDS
+    """
+    frames = list_frames(prefix)
+    deadline = time.time() + SETTLE_MAX_SECONDS
+    while time.time() < deadline:
+        time.sleep(SETTLE_SECONDS)
+        latest = list_frames(prefix)
+        if len(latest) == len(frames):
+            return latest  # settled; too-short videos are skipped by the caller
+        frames = latest
+    print(f"⚠️ Frames still arriving after {SETTLE_MAX_SECONDS}s ({len(frames)} so far)")
+    return None
+
+class LocalDetectionCache:
+    """Detections as small JSON files on local disk, evicted least-recently-used beyond max_bytes"""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.dir, self.max_bytes = directory, max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        entries = sorted(os.scandir(directory), key=lambda e: e.stat().st_atime)
+        self.sizes = OrderedDict((e.name, e.stat().st_size) for e in entries)  # oldest first
+        self.total = sum(self.sizes.values())
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.dir, key), "rb") as f:
+                value = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if key in self.sizes:
+                self.sizes.move_to_end(key)
+        return value
+
+    def put(self, key, detections):
+        data = json.dumps(detections).encode("utf-8")
+        with open(os.path.join(self.dir, key), "wb") as f:
+            f.write(data)
+        with self.lock:
+            self.total += len(data) - self.sizes.pop(key, 0)
+            self.sizes[key] = len(data)
+            while self.total > self.max_bytes and len(self.sizes) > 1:
+                old, size = self.sizes.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(os.path.join(self.dir, old))
+                except OSError:
+                    pass
+
+class S3DetectionCache:
+    """
+    Detections under s3://CACHE_BUCKET/CACHE_PREFIX, shared by every invocation.
+    A bounded in-memory LRU sits in front; the objects themselves are evicted by a
+    lifecycle expiration rule on the prefix.
+    """
+
+    def __init__(self, bucket=CACHE_BUCKET, prefix=CACHE_PREFIX, mem_entries=CACHE_MEM_ENTRIES):
+        self.bucket, self.prefix, self.mem_entries = bucket, prefix, mem_entries
+        self.mem = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _remember(self, key, detections):
+        with self.lock:
+            self.mem[key] = detections
+            self.mem.move_to_end(key)
+            while len(self.mem) > self.mem_entries:
+                self.mem.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.mem:
+                self.mem.move_to_end(key)
+                return self.mem[key]
+        try:
+            value = json.loads(s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")["Body"].read())
+        except ClientError:
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, detections):
+        s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}{key}",
+                      Body=json.dumps(detections).encode("utf-8"), ContentType="application/json")
+        self._remember(key, detections)
+
+def make_cache():
+    if CACHE_BACKEND == "s3":
+        return S3DetectionCache()
+    if CACHE_BACKEND == "local":
+        return LocalDetectionCache()
+    return None
+
+cache = make_cache()
+
+def cache_key(img: bytes):
+    """Content hash scoped to the endpoint + model version that produced the detections"""
+    scope = f"{detector.scope}|{MODEL_VERSION}|{RESIZE_SHORT_EDGE}x{RESIZE_LONG_EDGE}"
+    scope = hashlib.sha256(scope.encode("utf-8")).hexdigest()[:16]
+    return f"{scope}-{hashlib.sha256(img).hexdigest()}.json"
+
+def dhash(img: bytes):
+    """64-bit difference hash of a JPEG (9x8 grayscale, left/right gradient bits), None if unavailable"""
+    if Image is None:
+        return None
+    try:
+        im = Image.open(io.BytesIO(img))
+        im.draft("L", (64, 64))  # let libjpeg decode at reduced scale
+        px = list(im.convert("L").resize((9, 8)).getdata())
+    except Exception:
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+def prepare_image(img: bytes):
+    """
+    Downscale a JPEG to the model's working resolution and re-encode it.
+    → (bytes to send, (sx, sy) factors mapping model-space boxes back to original pixels)
+    """
+    if Image is None or RESIZE_SHORT_EDGE <= 0:
+        return img, (1.0, 1.0)
+    try:
+        im = Image.open(io.BytesIO(img))
+        w, h = im.size
+        scale = min(RESIZE_SHORT_EDGE / min(w, h), RESIZE_LONG_EDGE / max(w, h))
+        if scale >= 1.0:
+            return img, (1.0, 1.0)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        im.draft("RGB", size)  # DCT-domain pre-shrink, never below the target
+        out = io.BytesIO()
+        im.convert("RGB").resize(size, Image.BILINEAR).save(out, "JPEG", quality=RESIZE_QUALITY)
+    except Exception as e:
+        print(f"⚠️ Resize failed, sending original: {str(e)}")
+        return img, (1.0, 1.0)
+    return out.getvalue(), (w / size[0], h / size[1])
+
+def rescale(detections, factors):
+    """Map boxes from the resized frame back to original pixel coordinates (Tracker TTC math)"""
+    sx, sy = factors
+    if detections is None or (sx == 1.0 and sy == 1.0):
+        return detections
+    out = []
+    for d in detections:
+        b = d.get("box", {})
+        box = {"xmin": round(b.get("xmin", 0) * sx), "ymin": round(b.get("ymin", 0) * sy),
+               "xmax": round(b.get("xmax", 0) * sx), "ymax": round(b.get("ymax", 0) * sy)}
+        out.append({**d, "box": box})
+    return out
+
+def fetch_frame(key: str):
+    """→ (key, jpeg bytes, dHash); bytes is None if the download failed"""
+    try:
+        img = s3.get_object(Bucket=FRAMES_BUCKET, Key=key)["Body"].read()
+    except Exception as e:
+        print(f"❌ Error on frame {key}: {str(e)}")
+        traceback.print_exc()
+        return key, None, None
+    return key, img, dhash(img) if DEDUP_MAX_DISTANCE >= 0 else None
+
+def dedupe(loaded, ref):
+    """
+    Pick the frames that need detections. A frame within DEDUP_MAX_DISTANCE of the current
+    reference (the last frame sent for inference) is skipped and points at that reference;
+    comparing against the reference rather than the previous frame stops slow drift from
+    chaining skips forever. `ref` carries {"frame", "hash", "detections"} across windows; a
+    reference whose inference failed (detections None) is never reused, so its look-alikes
+    are re-inferred instead of inheriting the failure.
+    → (source frame key per loaded frame, keys to infer)
+    """
+    sources, todo = [], []
+    for key, img, h in loaded:
+        if img is None:
+            sources.append(None)
+            continue
+        failed = "detections" in ref and ref["detections"] is None
+        if (h is not None and ref.get("hash") is not None and not failed
+                and bin(h ^ ref["hash"]).count("1") <= DEDUP_MAX_DISTANCE):
+            sources.append(ref["frame"])
+            continue
+        ref["frame"], ref["hash"] = key, h
+        ref.pop("detections", None)
+        sources.append(key)
+        todo.append(key)
+    return sources, todo
+
+def promote_duplicates(loaded, sources, detections):
+    """
+    Look-alikes of a reference whose inference failed must not inherit the failure unsent:
+    the first one of each such group becomes the new reference and the rest point at it.
+    Updates `sources` in place → {failed reference: promoted frame key}
+    """
+    promoted = {}
+    for i, (key, _, _) in enumerate(loaded):
+        src = sources[i]
+        if src is None or src == key or detections.get(src) is not None:
+            continue
+        sources[i] = promoted.setdefault(src, key)
+    return promoted
+
+def infer_group(images):
+    """
+    Run a group of JPEGs through the endpoint → (detections per image, stats).
+    Images whose content hash is already cached skip the endpoint entirely.
+    """
+    results = [None] * len(images)
+    hashes = [cache_key(img) for img in images] if cache else []
+    if cache:
+        for i, h in enumerate(hashes):
+            try:
+                results[i] = cache.get(h)
+            except Exception as e:
+                print(f"⚠️ Cache read failed: {str(e)}")
+    todo = [i for i, r in enumerate(results) if r is None]
+    stats = {"cache_hits": len(images) - len(todo), "cache_misses": len(todo) if cache else 0}
+
+    prepared = [prepare_image(images[i]) for i in todo]
+    stats["bytes_original"] = sum(len(images[i]) for i in todo)
+    stats["bytes_sent"] = sum(len(p) for p, _ in prepared)
+    for i, (_, factors), dets in zip(todo, prepared, detector.detect([p for p, _ in prepared])):
+        dets = rescale(dets, factors)
+        results[i] = dets
+        if cache and dets is not None:
+            try:
+                cache.put(hashes[i], dets)
+            except Exception as e:
+                print(f"⚠️ Cache write failed: {str(e)}")
+    return results, stats
+
+def _box_iou(a, b):
+    ix = max(0, min(a["xmax"], b["xmax"]) - max(a["xmin"], b["xmin"]))
+    iy = max(0, min(a["ymax"], b["ymax"]) - max(a["ymin"], b["ymin"]))
+    inter = ix * iy
+    union = ((a["xmax"] - a["xmin"]) * (a["ymax"] - a["ymin"])
+             + (b["xmax"] - b["xmin"]) * (b["ymax"] - b["ymin"]) - inter + 1e-6)
+    return inter / union
+
+def match_detections(dets_a, dets_b, min_iou=0.1):
+    """Greedy same-label IoU pairing between two keyframes → [(i, j)]"""
+    cands = sorted(((_box_iou(a["box"], b["box"]), i, j)
+                    for i, a in enumerate(dets_a) for j, b in enumerate(dets_b)
+                    if a.get("label") == b.get("label")), reverse=True)
+    used_a, used_b, pairs = set(), set(), []
+    for v, i, j in cands:
+        if v < min_iou:
+            break
+        if i not in used_a and j not in used_b:
+            used_a.add(i); used_b.add(j); pairs.append((i, j))
+    return pairs
+
+def gap_is_risky(dets_a, dets_b, frames_apart):
+    """True if the boxes between two keyframes can't be trusted to a straight-line interpolation"""
+    if dets_a is None or dets_b is None:
+        return True
+    watched_a = [i for i, d in enumerate(dets_a) if d.get("label") in KEYFRAME_LABELS]
+    watched_b = [j for j, d in enumerate(dets_b) if d.get("label") in KEYFRAME_LABELS]
+    pairs = [(i, j) for i, j in match_detections(dets_a, dets_b) if i in watched_a]
+    if len(pairs) != len(watched_a) or len(pairs) != len(watched_b):
+        return True  # tracks appeared, vanished or jumped too far to overlap
+    dt = frames_apart / FPS
+    for i, j in pairs:
+        a, b = dets_a[i]["box"], dets_b[j]["box"]
+        dx = (b["xmin"] + b["xmax"] - a["xmin"] - a["xmax"]) / 2.0
+        dy = (b["ymin"] + b["ymax"] - a["ymin"] - a["ymax"]) / 2.0
+        if (dx * dx + dy * dy) ** 0.5 / frames_apart > KEYFRAME_MOTION_PX:
+            return True
+        ha, hb = max(1, a["ymax"] - a["ymin"]), max(1, b["ymax"] - b["ymin"])
+        v = (1.0 / ha - 1.0 / hb) / dt  # same distance proxy as Tracker.ttc_from_heights
+        if v > 1e-6 and (1.0 / hb) / v <= KEYFRAME_TTC_S:
+            return True
+    return False
+
+def interpolate(dets_a, dets_b, t):
+    """Detections at fraction t ∈ (0, 1) between two keyframes; unmatched boxes hold on their side"""
+    if dets_a is None or dets_b is None:
+        return None
+    pairs = match_detections(dets_a, dets_b)
+    out = []
+    for i, j in pairs:
+        a, b = dets_a[i], dets_b[j]
+        box = {k: round(a["box"][k] + (b["box"][k] - a["box"][k]) * t) for k in ("xmin", "ymin", "xmax", "ymax")}
+        out.append({"score": round(a.get("score", 0) + (b.get("score", 0) - a.get("score", 0)) * t, 4),
+                    "label": a.get("label"), "box": box})
+    side, taken = (dets_a, {i for i, _ in pairs}) if t < 0.5 else (dets_b, {j for _, j in pairs})
+    out += [d for k, d in enumerate(side) if k not in taken]
+    return out
+
+def sparse_detect(todo, position, detect, detections):
+    """
+    Keyframe mode: detect every KEYFRAME_MAX_K-th candidate (and the last), then keep halving
+    gaps whose endpoints look risky until they are calm or KEYFRAME_MIN_K wide. Each level is
+    one batched detect() call; everything left between keyframes is interpolated.
+    → set of propagated keys
+    """
+    n = len(todo)
+    marks = sorted(set(range(0, n, KEYFRAME_MAX_K)) | {n - 1})
+    detect([todo[i] for i in marks])
+    gaps, calm = list(zip(marks, marks[1:])), []
+    while gaps:
+        split, nxt = [], []
+        for a, b in gaps:
+            apart = position[todo[b]] - position[todo[a]]
+            if b - a > KEYFRAME_MIN_K and gap_is_risky(detections[todo[a]], detections[todo[b]], apart):
+                mid = (a + b) // 2
+                split.append(mid)
+                nxt += [(a, mid), (mid, b)]
+            else:
+                calm.append((a, b))
+        if split:
+            detect([todo[m] for m in split])
+        gaps = nxt
+
+    propagated = set()
+    for a, b in calm:
+        ka, kb = todo[a], todo[b]
+        for i in range(a + 1, b):
+            t = (position[todo[i]] - position[ka]) / (position[kb] - position[ka])
+            detections[todo[i]] = interpolate(detections[ka], detections[kb], t)
+            propagated.add(todo[i])
+    return propagated
+
+class Prefetcher:
+    """
+    Producer side of the frame pipeline: downloads (and dHashes) frames in order on its own
+    pool while the consumer runs inference, holding at most `depth` frames not yet taken.
+    """
+
+    def __init__(self, keys, depth=PREFETCH_FRAMES, workers=PREFETCH_WORKERS):
+        self.keys, self.next, self.depth = keys, 0, depth
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.queue = deque()
+        self._fill()
+
+    def _fill(self):
+        while self.next < len(self.keys) and len(self.queue) < self.depth:
+            self.queue.append(self.pool.submit(fetch_frame, self.keys[self.next]))
+            self.next += 1
+
+    def take(self, n):
+        """→ the next n fetch_frame results, in key order (blocks until they are downloaded)"""
+        out = []
+        while len(out) < n and self.queue:
+            out.append(self.queue.popleft().result())
+            self._fill()  # keep the download pool busy while the caller works
+        return out
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.queue.clear()
+
+def process_window(pool, loaded, ckpt):
+    """Near-duplicate filter → (sparse) batched inference for one fetched window → JSONL lines in key order"""
+    ref = ckpt.setdefault("dedup_ref", {})
+    prev_ref = dict(ref)
+    sources, todo = dedupe(loaded, ref)
+
+    images = {key: img for key, img, _ in loaded}
+    detections = {}
+    if prev_ref.get("frame"):
+        detections[prev_ref["frame"]] = prev_ref.get("detections")
+
+    def detect(keys):
+        groups = [keys[i:i + BATCH_SIZE] for i in range(0, len(keys), BATCH_SIZE)]
+        # map() yields results in submission order, so detections line up with their keys
+        for group, (dets, stats) in zip(groups, pool.map(lambda g: infer_group([images[k] for k in g]), groups)):
+            detections.update(zip(group, dets))
+            for name, n in stats.items():
+                ckpt["stats"][name] = ckpt["stats"].get(name, 0) + n
+
+    propagated = set()
+    if KEYFRAME_MAX_K > 1 and todo:
+        position = {key: i for i, (key, _, _) in enumerate(loaded)}
+        propagated = sparse_detect(todo, position, detect, detections)
+        ckpt["stats"]["propagated"] = ckpt["stats"].get("propagated", 0) + len(propagated)
+    else:
+        detect(todo)
+    hashes = {key: h for key, _, h in loaded}
+    while True:  # one more frame per failed group and round, until each group has a result
+        promoted = promote_duplicates(loaded, sources, detections)
+        if not promoted:
+            break
+        detect(list(promoted.values()))
+        if ref.get("frame") in promoted:
+            ref["frame"] = promoted[ref["frame"]]
+            ref["hash"] = hashes[ref["frame"]]
+    if ref.get("frame"):
+        ref["detections"] = detections.get(ref["frame"])
+        if ref["detections"] is None:
+            ref["hash"] = None
+    return build_lines([key for key, _, _ in loaded], sources, detections, propagated, ckpt["stats"])
+
+def nms(dets, iou_thresh):
+    """Greedy same-label non-maximum suppression; keeps the highest-scoring box of each overlap"""
+    kept = []
+    for d in sorted(dets, key=lambda d: d.get("score", 0), reverse=True):
+        if all(k.get("label") != d.get("label") or _box_iou(k["box"], d["box"]) < iou_thresh for k in kept):
+            kept.append(d)
+    return kept
+
+def filter_detections(dets):
+    """Label allow-list → min score → NMS → top-k, highest score first when anything is cut"""
+    out = [d for d in dets if (not DETECT_LABELS or d.get("label") in DETECT_LABELS)
+           and d.get("score", 0) >= DETECT_MIN_SCORE]
+    if DETECT_NMS_IOU > 0:
+        out = nms(out, DETECT_NMS_IOU)
+    if DETECT_TOP_K > 0 and len(out) > DETECT_TOP_K:
+        out = sorted(out, key=lambda d: d.get("score", 0), reverse=True)[:DETECT_TOP_K]
+    return out
+
+def make_record(key, dets, src, propagated, error=None):
+    """
+    One frame's JSONL record.
+    verbose: {"frame", "detections": [{label, score, box: {xmin, ymin, xmax, ymax}}], "skipped",
+              "source_frame", "propagated"} / {"frame", "failed", "error"}
+    compact: {"f", "d": [[label, score, xmin, ymin, xmax, ymax]], "s": source_frame, "p": 1} /
+             {"f", "e": error}, scores rounded to SCORE_DECIMALS and coordinates to whole pixels
+    """
+    if RECORD_FORMAT == "compact":
+        if error:
+            return {"f": key, "e": error}
+        rec = {"f": key, "d": [[d.get("label"), round(d.get("score", 0), SCORE_DECIMALS)]
+                               + [round(d["box"][k]) for k in ("xmin", "ymin", "xmax", "ymax")] for d in dets]}
+        if propagated:
+            rec["p"] = 1
+        if src != key:
+            rec["s"] = src
+        return rec
+    if error:
+        return {"frame": key, "failed": True, "error": error}
+    rec = {"frame": key, "detections": dets}
+    if propagated:
+        rec["propagated"] = True  # interpolated between keyframes, not seen by the model
+    if src != key:
+        # reused detections: the line stays so Tracker frame indices are unchanged
+        rec["skipped"], rec["source_frame"] = True, src
+    return rec
+
+def build_lines(keys, sources, detections, propagated, stats):
+    """
+    One JSONL line per frame, in key order. `sources` holds the frame whose detections each
+    frame uses (itself, or a near-duplicate reference), None if the frame never downloaded.
+    """
+    lines, skipped, failed, dropped = [], 0, 0, 0
+    filtered = {}  # duplicates share their source's filtered list
+    separators = (",", ":") if RECORD_FORMAT == "compact" else None
+    for key, src in zip(keys, sources):
+        dets = detections.get(src) if src is not None else None
+        if dets is None:
+            # explicit failure instead of an empty detection list, so Tracker doesn't read
+            # "no cars in this frame" and retire every track
+            lines.append(json.dumps(make_record(key, None, src, False,
+                                                error="download" if src is None else "inference"),
+                                    separators=separators))
+            failed += 1
+            continue
+        if src not in filtered:
+            filtered[src] = filter_detections(dets)
+        dropped += len(dets) - len(filtered[src])
+        skipped += src != key
+        lines.append(json.dumps(make_record(key, filtered[src], src, src in propagated), separators=separators))
+    stats["dedup_skipped"] = stats.get("dedup_skipped", 0) + skipped
+    stats["failed_frames"] = stats.get("failed_frames", 0) + failed
+    stats["detections_dropped"] = stats.get("detections_dropped", 0) + dropped
+    return lines
+
+def wait_for_endpoint(context):
+    """Hold the next window while every endpoint's breaker is open (bounded), rather than failing every frame in it"""
+    waited = 0.0
+    while not detector.ready() and waited < BREAKER_MAX_WAIT_S and not out_of_time(context):
+        time.sleep(1.0)
+        waited += 1.0
+    if waited:
+        print(f"⏳ Waited {waited:.0f}s for {detector.scope} to recover")
+
+def read_frames(bucket: str, report_key: str, first: int, count: int):
+    """
+    Records for frames [first, first + count) of a report, fetched through its index with two
+    ranged GETs, so the bytes transferred don't grow with video length. [] past the end.
+    """
+    try:
+        idx = s3.get_object(Bucket=bucket, Key=index_key(report_key),
+                            Range=f"bytes={first * INDEX_ENTRY_BYTES}-{(first + count) * INDEX_ENTRY_BYTES - 1}")["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "InvalidRange":
+            return []
+        raise
+    entries = [(int(idx[i:i + 12]), int(idx[i + 13:i + 21])) for i in range(0, len(idx), INDEX_ENTRY_BYTES)]
+    if not entries:
+        return []
+    start, end = entries[0][0], entries[-1][0] + entries[-1][1]
+    data = s3.get_object(Bucket=bucket, Key=report_key, Range=f"bytes={start}-{end - 1}")["Body"].read()
+    return [json.loads(data[offset - start:offset - start + length]) for offset, length in entries]
+
+def window_handler(event, context):
+    """
+    Random access for clients such as the report generator or a UI scrubber:
+    {"video_id", "start": frame | "t": seconds, "count"} → the JSONL records of that frame window.
+    """
+    try:
+        video_id = event["video_id"]
+        start = int(event["t"] * FPS) if "t" in event else int(event.get("start", 0))
+        count = max(1, min(int(event.get("count", 1)), WINDOW_MAX_FRAMES))
+    except (KeyError, TypeError, ValueError) as e:
+        return {"statusCode": 400, "error": f"invalid request: {str(e)}"}
+    try:
+        frames = read_frames(REPORTS_BUCKET, f"{video_id}/detections_all.jsonl", max(0, start), count)
+    except ClientError as e:
+        return {"statusCode": 404, "error": str(e)}
+    return {"statusCode": 200, "start": max(0, start), "frames": frames}
+
+def load_checkpoint(prefix: str):
+    """→ {"frames", "cursor", "upload"} from an interrupted run, or None"""
+    try:
+        body = s3.get_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CHECKPOINT_NAME}")["Body"].read()
+        return json.loads(body)
+    except ClientError:
+        return None
+
+def save_checkpoint(prefix: str, ckpt):
+    s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CHECKPOINT_NAME}",
+                  Body=json.dumps(ckpt).encode("utf-8"), ContentType="application/json")
+
+def clear_checkpoint(prefix: str):
+    s3.delete_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CHECKPOINT_NAME}")
+
+def publish_chunks(prefix: str, ckpt, lines, final=False):
+    """
+    Publish JSONL lines in ordered chunks of PUBLISH_CHUNK_FRAMES as <prefix>chunks/<seq>.jsonl.
+    The unpublished tail lives in the checkpoint, so a resumed run continues the sequence (a
+    chunk re-sent after a crash overwrites itself). final=True flushes the tail and writes the
+    completion marker.
+    """
+    if PUBLISH_CHUNK_FRAMES <= 0:
+        return
+    pub = ckpt.setdefault("publish", {"seq": 0, "pending": []})
+    pub["pending"] += lines
+    while len(pub["pending"]) >= PUBLISH_CHUNK_FRAMES or (final and pub["pending"]):
+        chunk, pub["pending"] = pub["pending"][:PUBLISH_CHUNK_FRAMES], pub["pending"][PUBLISH_CHUNK_FRAMES:]
+        s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CHUNK_PREFIX}{pub['seq']:06d}.jsonl",
+                      Body=("\n".join(chunk) + "\n").encode("utf-8"), ContentType="application/json")
+        pub["seq"] += 1
+    if final:
+        s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CHUNK_PREFIX}{COMPLETE_NAME}",
+                      Body=json.dumps({"chunks": pub["seq"], "frames": len(ckpt["frames"])}).encode("utf-8"),
+                      ContentType="application/json")
+        print(f"📦 Published {pub['seq']} detection chunks under s3://{REPORTS_BUCKET}/{prefix}{CHUNK_PREFIX}")
+
+def out_of_time(context):
+    return context is not None and context.get_remaining_time_in_millis() < TIME_MARGIN_MS
+
+def run_inference(prefix, ckpt, writer, context):
+    """
+    Run frames[cursor:] through a bounded worker pool, one CHECKPOINT_FRAMES window at a time.
+    Each finished window is streamed into the multipart writer and the cursor plus writer
+    state are checkpointed, so a crash or timeout only loses the window in flight. Returns
+    True once every frame is done, False if the run stopped early because the Lambda is
+    about to time out.
+    """
+    frames = ckpt["frames"]
+    prefetch = Prefetcher(frames[ckpt["cursor"]:])
+    try:
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            while ckpt["cursor"] < len(frames):
+                start = ckpt["cursor"]
+                loaded = prefetch.take(min(CHECKPOINT_FRAMES, len(frames) - start))
+                wait_for_endpoint(context)
+                lines = process_window(pool, loaded, ckpt)
+                writer.write_lines(lines)
+                publish_chunks(prefix, ckpt, lines)
+                ckpt["cursor"] = start + len(loaded)
+                print(f"Processed {ckpt['cursor']}/{len(frames)} frames...")
+                ckpt["upload"] = writer.state()
+                save_checkpoint(prefix, ckpt)
+
+                if ckpt["cursor"] < len(frames) and out_of_time(context):
+                    return False
+    finally:
+        prefetch.close()
+    return True
+
+def continue_later(context, video_id: str, owner: str):
+    """Re-invoke this function asynchronously to resume from the checkpoint"""
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({"resume": {"video_id": video_id, "owner": owner}}).encode("utf-8")
+    )
+
+def retry_later(context, event):
+    """Re-invoke this function asynchronously with the same event (e.g. while frames are still arriving)"""
+    if context is not None:
+        lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType="Event",
+                             Payload=json.dumps(event).encode("utf-8"))
+
+def _split_uri(uri: str):
+    """s3://bucket/key → (bucket, key)"""
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+def pack_batch(images):
+    """JPEGs → one x-image-batch body (same framing as the binary transport)"""
+    return b"".join(struct.pack(">I", len(img)) + img for img in images)
+
+def unpack_batch(body: bytes):
+    images, pos = [], 0
+    while pos < len(body):
+        (size,) = struct.unpack(">I", body[pos:pos + 4])
+        images.append(body[pos + 4:pos + 4 + size])
+        pos += 4 + size
+    return images
+
+class SageMakerAsyncQueue:
+    """
+    A SageMaker async inference endpoint. The endpoint reads each request body from S3 and
+    writes the response to its configured S3 output path; success/error notifications go to
+    SNS, which triggers collect_handler.
+    """
+
+    def __init__(self, endpoint=ASYNC_ENDPOINT):
+        self.endpoint = endpoint
+
+    def submit(self, inference_id: str, content_type: str, input_uri: str):
+        """→ (output URI, failure URI)"""
+        for attempt in range(INFER_RETRIES + 1):
+            try:
+                r = runtime.invoke_endpoint_async(EndpointName=self.endpoint, ContentType=content_type,
+                                                  InputLocation=input_uri, InferenceId=inference_id)
+                return r["OutputLocation"], r.get("FailureLocation")
+            except Exception as e:
+                if classify_error(e) == "client" or attempt == INFER_RETRIES:
+                    raise
+                time.sleep(backoff(attempt))
+
+class LocalAsyncQueue:
+    """
+    Stand-in for the async endpoint: a single background worker runs queued requests through
+    the configured detector, writes outputs next to the inputs and then notifies the collector,
+    the way the SNS topic would. drain() waits for everything queued so far.
+    """
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def submit(self, inference_id: str, content_type: str, input_uri: str):
+        bucket, key = _split_uri(input_uri)
+        base = key.replace(f"{ASYNC_PREFIX}in/", f"{ASYNC_PREFIX}out/").rsplit(".", 1)[0]
+        output, failure = f"s3://{bucket}/{base}.out", f"s3://{bucket}/{base}.err"
+        self.futures.append(self.pool.submit(self._run, input_uri, output, failure))
+        return output, failure
+
+    def _run(self, input_uri, output, failure):
+        try:
+            bucket, key = _split_uri(input_uri)
+            images = unpack_batch(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+            bucket, key = _split_uri(output)
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(detector.detect(images)).encode("utf-8"),
+                          ContentType="application/json")
+        except Exception as e:
+            bucket, key = _split_uri(failure)
+            s3.put_object(Bucket=bucket, Key=key, Body=str(e).encode("utf-8"), ContentType="text/plain")
+        video_id, number = job_number(input_uri)
+        collect_handler({"collect": {"video_id": video_id, "jobs": [number]}}, None)
+
+    def drain(self):
+        while self.futures:
+            self.futures.pop(0).result()
+
+def make_async_queue():
+    if INFER_MODE != "async":
+        return None
+    if ASYNC_QUEUE == "local":
+        return LocalAsyncQueue()
+    return SageMakerAsyncQueue()
+
+async_queue = make_async_queue()
+
+def submit_group(prefix: str, number: int, keys, images):
+    """Resize a group of frames, stage them as one batch object and queue it → job record"""
+    prepared = [prepare_image(images[k]) for k in keys]
+    input_key = f"{prefix}{ASYNC_PREFIX}in/{number:06d}.bin"
+    s3.put_object(Bucket=ASYNC_BUCKET, Key=input_key, Body=pack_batch([p for p, _ in prepared]),
+                  ContentType=BATCH_CONTENT_TYPE)
+    input_uri = f"s3://{ASYNC_BUCKET}/{input_key}"
+    output, failure = async_queue.submit(f"{prefix.rstrip('/')}-{number:06d}", BATCH_CONTENT_TYPE, input_uri)
+    return {"keys": keys, "scales": [f for _, f in prepared], "input": input_uri,
+            "output": output, "failure": failure}
+
+def submit_async(prefix, ckpt, context):
+    """
+    Async counterpart of run_inference: fetch and de-duplicate each window, then stage its
+    frames as ASYNC_BATCH_SIZE batches and queue them without waiting for results. The jobs
+    and per-frame sources are checkpointed for the collector. Keyframe mode needs results
+    between levels, so every non-duplicate frame is submitted.
+    """
+    frames = ckpt["frames"]
+    jobs = ckpt.setdefault("jobs", [])
+    sources = ckpt.setdefault("sources", [])
+    ref = ckpt.setdefault("dedup_ref", {})
+    prefetch = Prefetcher(frames[ckpt["cursor"]:])
+    try:
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            while ckpt["cursor"] < len(frames):
+                start = ckpt["cursor"]
+                loaded = prefetch.take(min(CHECKPOINT_FRAMES, len(frames) - start))
+                window_sources, todo = dedupe(loaded, ref)
+                images = {key: img for key, img, _ in loaded}
+                groups = [todo[i:i + ASYNC_BATCH_SIZE] for i in range(0, len(todo), ASYNC_BATCH_SIZE)]
+                first = len(jobs)
+                jobs.extend(pool.map(lambda ig: submit_group(prefix, first + ig[0], ig[1], images), enumerate(groups)))
+                sources.extend(window_sources)
+                ckpt["cursor"] = start + len(loaded)
+                print(f"Submitted {ckpt['cursor']}/{len(frames)} frames ({len(jobs)} async requests)...")
+                save_checkpoint(prefix, ckpt)
+
+                if ckpt["cursor"] < len(frames) and out_of_time(context):
+                    return False
+    finally:
+        prefetch.close()
+    return True
+
+def job_number(input_uri: str):
+    """s3://<bucket>/<video>/_async/in/000012.bin → ("<video>", 12)"""
+    key = _split_uri(input_uri)[1]
+    return key.split("/")[0], int(key.rsplit("/", 1)[1].split(".")[0])
+
+def read_landed(prefix: str):
+    """→ (set of landed async request numbers, ETag or None)"""
+    try:
+        r = s3.get_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{LANDED_NAME}")
+        return set(json.loads(r["Body"].read())["jobs"]), r["ETag"]
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return set(), None
+        raise
+
+def record_landed(prefix: str, numbers):
+    """
+    Add async request numbers to <prefix>_async_landed.json → every number landed so far.
+    Notifications arrive concurrently, so the update is a compare-and-swap on the ETag,
+    retried with backoff when another collector wrote first.
+    """
+    attempt = 0
+    while True:
+        landed, etag = read_landed(prefix)
+        if set(numbers) <= landed:
+            return landed
+        landed |= set(numbers)
+        cond = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{LANDED_NAME}", ContentType="application/json",
+                          Body=json.dumps({"jobs": sorted(landed)}).encode("utf-8"), **cond)
+            return landed
+        except ClientError as e:
+            if not _precondition_failed(e):
+                raise
+        time.sleep(backoff(min(attempt, 6)))
+        attempt += 1
+
+def _exists(uri):
+    if not uri:
+        return False
+    bucket, key = _split_uri(uri)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError:
+        return False
+
+def load_output(job):
+    """→ one detection list (or None) per frame of an async job, in original pixel coordinates"""
+    if not _exists(job["output"]):
+        return [None] * len(job["keys"])  # landed in the failure location
+    bucket, key = _split_uri(job["output"])
+    result = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    if len(job["keys"]) == 1 and not (len(result) == 1 and isinstance(result[0], (list, type(None)))):
+        result = [result]  # single-image requests answer with a bare detection list
+    if len(result) != len(job["keys"]):
+        print(f"⚠️ Unexpected async output shape for {job['output']}")
+        return [None] * len(job["keys"])
+    return [rescale(dets, f) for dets, f in zip(result, job["scales"])]
+
+def delete_uris(uris):
+    """Best-effort cleanup of staged async inputs/outputs"""
+    by_bucket = {}
+    for uri in uris:
+        if uri:
+            bucket, key = _split_uri(uri)
+            by_bucket.setdefault(bucket, []).append({"Key": key})
+    for bucket, keys in by_bucket.items():
+        for i in range(0, len(keys), 1000):
+            try:
+                s3.delete_objects(Bucket=bucket, Delete={"Objects": keys[i:i + 1000], "Quiet": True})
+            except Exception as e:
+                print(f"⚠️ Could not delete async objects in {bucket}: {str(e)}")
+
+def collect_video(video_id: str, finished=()):
+    """
+    Assemble detections_all.jsonl once every async output (or failure) for the video has
+    landed. `finished` are the request numbers a notification reported; they are recorded in
+    <prefix>_async_landed.json, so each notification costs O(1) S3 calls instead of a HEAD per
+    request. A call without them (run_async, a manual {"collect"}) also HEADs the outstanding
+    requests once, in case a notification was lost. Only a video in "submitted" state is
+    collected, and the collector that moves the claim to "collecting" (If-Match on its ETag)
+    is the only one that writes the report.
+    """
+    prefix = f"{video_id}/"
+    claim, etag = read_claim(prefix)
+    if claim and claim.get("status") == "done":
+        return {"statusCode": 200, "status": "done"}
+    # recorded even before submission ends: fast requests can land while it is still running
+    landed = record_landed(prefix, finished) if finished else read_landed(prefix)[0]
+    if not claim or claim.get("status") != "submitted":
+        return {"statusCode": 200, "status": (claim or {}).get("status")}
+    ckpt = load_checkpoint(prefix)
+    if not ckpt or ckpt["cursor"] < len(ckpt["frames"]):
+        return {"statusCode": 200, "status": "submitting"}
+
+    jobs = ckpt["jobs"]
+    outstanding = [n for n in range(len(jobs)) if n not in landed]
+    if outstanding and not finished:
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            found = [n for n, ok in zip(outstanding, pool.map(
+                lambda n: _exists(jobs[n]["output"]) or _exists(jobs[n]["failure"]), outstanding)) if ok]
+        if found:
+            record_landed(prefix, found)
+        outstanding = [n for n in outstanding if n not in set(found)]
+    if outstanding:
+        print(f"⏳ {len(outstanding)}/{len(jobs)} async requests for {video_id} still pending")
+        return {"statusCode": 202, "pending": len(outstanding)}
+
+    owner = claim["owner"]
+    try:
+        s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CLAIM_NAME}",
+                      Body=_claim_body(owner, "collecting"), ContentType="application/json", IfMatch=etag)
+    except ClientError as e:
+        if not _precondition_failed(e):
+            raise
+        return {"statusCode": 200, "status": "collecting"}
+
+    report_key = f"{prefix}detections_all.jsonl"
+    writer = IndexedJSONLWriter(s3, REPORTS_BUCKET, report_key)
+    stats = ckpt["stats"]
+    try:
+        detections = {}
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            for job, dets in zip(jobs, pool.map(load_output, jobs)):
+                detections.update(zip(job["keys"], dets))
+        lines = build_lines(ckpt["frames"], ckpt["sources"], detections, set(), stats)
+        writer.write_lines(lines)
+        writer.close()
+        publish_chunks(prefix, ckpt, lines, final=True)
+        print(f"✅ Collected {len(jobs)} async outputs into s3://{REPORTS_BUCKET}/{report_key} "
+              f"({writer.bytes_written} bytes)")
+        clear_checkpoint(prefix)
+        finish_claim(prefix, owner, stats)
+        s3.delete_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{LANDED_NAME}")
+    except Exception as e:
+        print("❌ Failed to collect async outputs:", str(e))
+        traceback.print_exc()
+        writer.abort()
+        s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CLAIM_NAME}",
+                      Body=_claim_body(owner, "submitted", lease=ASYNC_LEASE_SECONDS),
+                      ContentType="application/json")  # let the next notification retry
+        return {"statusCode": 500, "error": "collect failed"}
+    delete_uris([u for j in jobs for u in (j["input"], j["output"], j["failure"])])
+    return {"statusCode": 200, "report": f"s3://{REPORTS_BUCKET}/{report_key}", "stats": stats}
+
+def collect_handler(event, context):
+    """
+    Collector entry point. Accepts the async endpoint's SNS success/error notifications
+    (video and request number come from the request's input location) or
+    {"collect": {"video_id", "jobs": [request numbers, optional]}}.
+    """
+    finished = {}
+    if "collect" in event:
+        finished.setdefault(event["collect"]["video_id"], []).extend(event["collect"].get("jobs", []))
+    for rec in event.get("Records", []):
+        if "Sns" not in rec:
+            continue
+        msg = json.loads(rec["Sns"]["Message"])
+        uri = msg.get("requestParameters", {}).get("inputLocation", "")
+        if uri.startswith("s3://"):
+            video_id, number = job_number(uri)
+            finished.setdefault(video_id, []).append(number)
+    results = {}
+    for video_id, numbers in finished.items():
+        results[video_id] = collect_video(video_id, numbers)
+    return {"statusCode": 200, "videos": results}
+
+def run_async(prefix, video_id, owner, ckpt, context):
+    """Submit the video's frames to the async endpoint; the collector writes the report later"""
+    print(f"📨 Submitting {len(ckpt['frames']) - ckpt['cursor']} frames to {ASYNC_ENDPOINT} "
+          f"({ASYNC_QUEUE} queue, ≤{ASYNC_BATCH_SIZE} frames/request)")
+    ckpt.setdefault("stats", {})
+    if not submit_async(prefix, ckpt, context):
+        print(f"⏸️ Low on time at frame {ckpt['cursor']}/{len(ckpt['frames'])} → continuing in a new invocation")
+        continue_later(context, video_id, owner)
+        return {"statusCode": 202, "cursor": ckpt["cursor"]}
+    # outputs land over minutes/hours: hold the claim for that long, then let the collector take it
+    s3.put_object(Bucket=REPORTS_BUCKET, Key=f"{prefix}{CLAIM_NAME}",
+                  Body=_claim_body(owner, "submitted", lease=ASYNC_LEASE_SECONDS), ContentType="application/json")
+    print(f"✅ Queued {len(ckpt['jobs'])} async requests for {video_id}")
+    if ASYNC_QUEUE == "local":
+        async_queue.drain()  # the stand-in finishes within this invocation
+    # everything may already be there (all frames duplicates/failed, or a fast queue)
+    collect_video(video_id)
+    return {"statusCode": 202, "submitted": len(ckpt["jobs"])}
+
+def lambda_handler(event, context):
     print("🚀 Lambda triggered")
     print(json.dumps(event, indent=2))
 
+    # preferred: {"manifest": {bucket, key}} from the MediaConvert completion handler;
+    # legacy: one S3 event per uploaded frame
+    manifest, resume = None, event.get("resume")
     try:
-        rec = event["Records"][0]["s3"]
-        key = rec["object"]["key"]
-        print(f"🖼️ Frame uploaded: {key}")
+        if resume:
+            key = f"{resume['video_id']}/{CHECKPOINT_NAME}"
+            print(f"⏩ Continuing {resume['video_id']} from checkpoint")
+        elif "manifest" in event:
+            ref = event["manifest"]
+            key = ref["key"]
+            manifest = json.loads(s3.get_object(Bucket=ref["bucket"], Key=key)["Body"].read())
+            print(f"📜 Frame manifest: s3://{ref['bucket']}/{key} ({manifest['count']} frames)")
+        else:
+            rec = event["Records"][0]["s3"]
+            key = rec["object"]["key"]
+            print(f"🖼️ Frame uploaded: {key}")
     except Exception as e:
-        print("❌ Invalid S3 event:", str(e))
+        print("❌ Invalid event:", str(e))
         traceback.print_exc()
-        return {"statusCode": 400, "error": "invalid s3 event"}
+        return {"statusCode": 400, "error": "invalid event"}
 
     # derive video prefix "<videoId>/"
     m = re.match(r"([^/]+)/", key)
@@ -66,46 +1661,95 @@ def lambda_handler(event, _):
 
     report_key = f"{prefix}detections_all.jsonl"
 
-    # skip if already processed
-    try:
-        s3.head_object(Bucket=REPORTS_BUCKET, Key=report_key)
-        print("detections_all.jsonl already exists → skipping")
+    # single-flight: only the trigger that wins the claim does any further work
+    owner = (resume or {}).get("owner") or getattr(context, "aws_request_id", None) or str(uuid.uuid4())
+    claimed, status = claim_video(prefix, owner)
+    if not claimed:
+        if status == "done":
+            print("detections_all.jsonl already exists → skipping")
+        else:
+            print(f"🔒 Video {video_id} is claimed by another worker ({status}) → skipping")
         return {"statusCode": 200}
-    except s3.exceptions.ClientError:
-        print("✅ No existing report, proceeding")
 
-    # collect frames
-    frames = list_frames(prefix)
-    if len(frames) < MIN_FRAMES:
-        print(f"⚠️ Only {len(frames)} frames (<{MIN_FRAMES}) → skipping")
-        return {"statusCode": 200}
+    ckpt = load_checkpoint(prefix)
+    if ckpt:
+        # checked before the report: a retried close may already have written it
+        print(f"⏩ Resuming at frame {ckpt['cursor']}/{len(ckpt['frames'])}")
+    else:
+        # videos processed before claims existed only have the report
+        try:
+            s3.head_object(Bucket=REPORTS_BUCKET, Key=report_key)
+            print("detections_all.jsonl already exists → skipping")
+            finish_claim(prefix, owner)
+            return {"statusCode": 200}
+        except ClientError:
+            print("✅ No existing report, proceeding")
 
-    print(f"🚗 Running inference for {len(frames)} frames on {SM_ENDPOINT}")
+        # the manifest already lists every frame; otherwise wait for extraction to settle
+        frames = manifest["frames"] if manifest else wait_for_frames(prefix)
+        if frames is None:
+            # never finish on a partial set: hand the video back and try again later
+            release_claim(prefix)
+            attempt = event.get("settle_attempt", 0) + 1
+            if attempt > SETTLE_RETRIES:
+                print(f"❌ {video_id} still being extracted after {SETTLE_RETRIES} retries → giving up")
+                return {"statusCode": 200, "status": "frames_unsettled"}
+            print(f"⏳ {video_id} is still being extracted → releasing the claim and retrying later "
+                  f"({attempt}/{SETTLE_RETRIES})")
+            retry_later(context, {**event, "settle_attempt": attempt})
+            return {"statusCode": 202, "status": "frames_pending"}
+        if len(frames) < MIN_FRAMES:
+            print(f"⚠️ Only {len(frames)} frames (<{MIN_FRAMES}) → skipping")
+            release_claim(prefix)
+            return {"statusCode": 200}
+        ckpt = {"frames": frames, "cursor": 0, "upload": {}, "stats": {}}
 
-    lines = []
-    for i, k in enumerate(frames, 1):
-        try:
-            img = s3.get_object(Bucket=FRAMES_BUCKET, Key=k)["Body"].read()
-            b64 = base64.b64encode(img).decode("utf-8")
-            detections = invoke_model(b64)
-            lines.append(json.dumps({"frame": k, "detections": detections}))
-            if i % 10 == 0:
-                print(f"Processed {i}/{len(frames)} frames...")
-        except Exception as e:
-            print(f"❌ Error on frame {k}: {str(e)}")
-            traceback.print_exc()
+    if INFER_MODE == "async":
+        return run_async(prefix, video_id, owner, ckpt, context)
+
+    print(f"🚗 Running inference for {len(ckpt['frames']) - ckpt['cursor']} frames on {detector.scope} "
+          f"({CONCURRENCY} workers, ≤{BATCH_SIZE} frames/call, {TRANSPORT})")
+
+    ckpt.setdefault("stats", {})
+    writer = IndexedJSONLWriter(s3, REPORTS_BUCKET, report_key, state=ckpt["upload"])
+    detector.bind_video(video_id)
+    try:
+        finished = run_inference(prefix, ckpt, writer, context)
+    finally:
+        detector.release_video()
+    if not finished:
+        print(f"⏸️ Low on time at frame {ckpt['cursor']}/{len(ckpt['frames'])} → continuing in a new invocation")
+        continue_later(context, video_id, owner)
+        return {"statusCode": 202, "cursor": ckpt["cursor"]}
+
+    stats = ckpt["stats"]
+    if cache:
+        looked_up = stats.get("cache_hits", 0) + stats.get("cache_misses", 0)
+        stats["cache_hit_rate"] = round(stats.get("cache_hits", 0) / looked_up, 3) if looked_up else 0.0
+        print(f"🗃️ Cache: {stats.get('cache_hits', 0)}/{looked_up} frames served from cache "
+              f"({stats['cache_hit_rate']:.0%}), {stats.get('cache_hits', 0)} endpoint inferences saved")
+
+    if stats.get("failed_frames"):
+        print(f"⚠️ {stats['failed_frames']} frames failed and are marked \"failed\" in the JSONL")
+    if stats.get("bytes_original"):
+        print(f"📉 Payload: {stats['bytes_sent']} of {stats['bytes_original']} frame bytes sent "
+              f"({stats['bytes_sent'] / stats['bytes_original']:.0%})")
 
     try:
-        s3.put_object(
-            Bucket=REPORTS_BUCKET,
-            Key=report_key,
-            Body="\n".join(lines).encode("utf-8"),
-            ContentType="application/json"
-        )
-        print(f"✅ Uploaded detections to s3://{REPORTS_BUCKET}/{report_key}")
+        writer.close()
+        print(f"✅ Uploaded detections to s3://{REPORTS_BUCKET}/{report_key} "
+              f"({writer.bytes_written} bytes, {len(writer.parts)} parts) + frame index")
+        publish_chunks(prefix, ckpt, [], final=True)
+        clear_checkpoint(prefix)
+        finish_claim(prefix, owner, stats)
     except Exception as e:
+        # keep the checkpoint (and our claim) and fail the invocation: the async retry runs
+        # with the same request id, renews the claim and resumes the close from here
         print("❌ Failed to upload JSONL:", str(e))
         traceback.print_exc()
+        ckpt["upload"] = writer.state()
+        save_checkpoint(prefix, ckpt)
+        raise
 
     print("🎯 Lambda completed successfully")
-    return {"statusCode": 200, "report": f"s3://{REPORTS_BUCKET}/{report_key}"}
\ No newline at end of file
+    return {"statusCode": 200, "report": f"s3://{REPORTS_BUCKET}/{report_key}", "stats": stats}
\ No newline at end of file
@@ -1,15 +1,68 @@
-import os, json, math, boto3
+import os, re, json, math, time, random, boto3
+from array import array
+from botocore.exceptions import ClientError
+try:
+    import numpy as np
+except ImportError:  # association falls back to the pure-Python IoU loop
+    np = None
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # hungarian() below is used instead
+    linear_sum_assignment = None
 
 s3 = boto3.client("s3")
 
 FPS = float(os.environ.get("FPS", "5"))  # we extracted at 5 fps
 IOU_THRESH = float(os.environ.get("IOU_THRESH", "0.3"))
+# greedy: tracks pick boxes in order; hungarian: globally optimal IoU assignment (needs NumPy)
+ASSIGNMENT = os.environ.get("ASSIGNMENT", "greedy").lower()
+# iou: a track ends at its first unmatched frame; sort: constant-velocity alpha-beta filter per
+# track, matched on predicted boxes, coasting up to MAX_AGE missed frames (needs NumPy)
+TRACKER_ENGINE = os.environ.get("TRACKER_ENGINE", "iou").lower()
+MAX_AGE    = int(os.environ.get("MAX_AGE", "3"))          # frames a track may go unmatched
+SORT_ALPHA = float(os.environ.get("SORT_ALPHA", "0.7"))   # position/size gain
+SORT_BETA  = float(os.environ.get("SORT_BETA", "0.3"))    # velocity gain
 
-def parse_jsonl(b: bytes):
-    for line in b.splitlines():
-        line = line.strip()
-        if line:
-            yield json.loads(line)
+# incremental mode: consume AnalyzeFrames' <video>/chunks/NNNNNN.jsonl as they land, carrying
+# tracker state in <video>/_tracker_state.json; tracks.json is written after chunks/_complete.json
+TRACKER_MODE  = os.environ.get("TRACKER_MODE", "full").lower()  # full | incremental
+CHUNK_PREFIX  = "chunks/"
+COMPLETE_NAME = "_complete.json"
+STATE_NAME    = "_tracker_state.json"
+LINE_CHUNK_BYTES = 64 * 1024  # read size while streaming JSONL from S3
+
+FRAME_NO = re.compile(r"\.(\d+)\.jpg$", re.IGNORECASE)  # <video_id>.0000042.jpg
+
+def frame_index(key: str, fallback: int):
+    """Frame number from the MediaConvert file name, so gaps (failed frames) keep true timing"""
+    m = FRAME_NO.search(key)
+    return int(m.group(1)) if m else fallback
+
+def read_frame(rec):
+    """
+    → (frame key, car boxes), boxes None if AnalyzeFrames marked the frame failed.
+    Reads both record formats: verbose {"frame", "detections": [{label, score, box}]} and
+    compact {"f", "d": [[label, score, xmin, ymin, xmax, ymax]]} ({"f", "e"} when failed).
+    """
+    if "f" in rec:
+        if "e" in rec:
+            return rec["f"], None
+        return rec["f"], [{"xmin": float(x1), "ymin": float(y1), "xmax": float(x2), "ymax": float(y2),
+                           "score": float(score)}
+                          for label, score, x1, y1, x2, y2 in rec.get("d", []) if label == "car"]
+    if rec.get("failed"):
+        return rec["frame"], None
+    boxes = []
+    for c in rec.get("detections", []):
+        if c.get("label") != "car":
+            continue
+        b = c.get("box", {})
+        boxes.append({
+            "xmin": float(b.get("xmin", 0)), "ymin": float(b.get("ymin", 0)),
+            "xmax": float(b.get("xmax", 0)), "ymax": float(b.get("ymax", 0)),
+            "score": float(c.get("score", 0.0))
+        })
+    return rec["frame"], boxes
 
 def iou(a, b):
     ax1, ay1, ax2, ay2 = a["xmin"], a["ymin"], a["xmax"], a["ymax"]
@@ -23,6 +76,132 @@ def iou(a, b):
     union = area_a + area_b - inter + 1e-6
     return inter / union
 
+def xyxy(boxes):
+    """Box dicts → N×4 float array of (xmin, ymin, xmax, ymax)"""
+    return np.array([[b["xmin"], b["ymin"], b["xmax"], b["ymax"]] for b in boxes], dtype=float).reshape(-1, 4)
+
+def iou_matrix(a, b):
+    """IoU of every row of a (T×4) against every row of b (B×4) → T×B, same arithmetic as iou()"""
+    iw = np.maximum(0, np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]))
+    ih = np.maximum(0, np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]))
+    inter = iw * ih
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter + 1e-6
+    return inter / union
+
+def associate_python(lasts, boxes):
+    assigned, matches = set(), []
+    for last in lasts:
+        best_j, best_iou = None, 0.0
+        for j, b in enumerate(boxes):
+            if j in assigned: 
+                continue
+            i = iou(last, b)
+            if i > best_iou:
+                best_iou, best_j = i, j
+        if best_j is not None and best_iou >= IOU_THRESH:
+            assigned.add(best_j)
+            matches.append(best_j)
+        else:
+            matches.append(None)
+    return matches
+
+def associate_numpy(lasts, boxes):
+    return greedy_matches(iou_matrix(xyxy(lasts), xyxy(boxes)))
+
+def greedy_matches(m):
+    """Greedy walk over a tracks × boxes IoU matrix → box index or None per track"""
+    taken = np.zeros(m.shape[1], dtype=bool)
+    matches = []
+    for row in m:
+        row = np.where(taken, -1.0, row)
+        j = int(row.argmax())  # first maximum, like the strict ">" scan
+        if row[j] > 0.0 and row[j] >= IOU_THRESH:
+            taken[j] = True
+            matches.append(j)
+        else:
+            matches.append(None)
+    return matches
+
+def hungarian(cost):
+    """
+    Minimum-cost assignment for a rectangular cost matrix → (rows, cols).
+    Shortest augmenting paths with row/column potentials, O(n²·m), the scan over columns
+    vectorized; used when SciPy's linear_sum_assignment isn't installed.
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)    # p[j]: row (1-based) assigned to column j; p[0] is the row being added
+    way = np.zeros(m + 1, dtype=int)  # previous column on the augmenting path
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = ~used[1:] & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            free = np.where(used[1:], np.inf, minv[1:])
+            j1 = int(free.argmin()) + 1
+            delta = free[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:  # flip the augmenting path
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+def associate_hungarian(lasts, boxes):
+    return optimal_matches(iou_matrix(xyxy(lasts), xyxy(boxes)))
+
+def optimal_matches(m):
+    """
+    Globally optimal assignment: the most pairs that pass the gate, then the highest total IoU
+    among those; pairs below IOU_THRESH (or not overlapping) can't match
+    """
+    allowed = (m > 0.0) & (m >= IOU_THRESH)
+    cost = np.where(allowed, 1.0 - m, 1e6)  # gated pairs only get picked when nothing else fits, then dropped
+    rows, cols = (linear_sum_assignment or hungarian)(cost)
+    matches = [None] * m.shape[0]
+    for r, c in zip(rows, cols):
+        if allowed[r, c]:
+            matches[r] = int(c)
+    return matches
+
+def associate(lasts, boxes, assignment=None):
+    """
+    Match the active tracks' last boxes to this frame's boxes → box index or None per track.
+    greedy: in track order, each track takes its best-IoU box not yet taken (the first one on
+    ties) if that IoU is ≥ IOU_THRESH. hungarian: the assignment with the highest total IoU
+    under the same gate, so an early track can't steal a later track's better match.
+    The tracks × boxes IoU matrix is computed in one NumPy operation when NumPy is available.
+    """
+    if not lasts or not boxes:
+        return [None] * len(lasts)
+    if (assignment or ASSIGNMENT) == "hungarian" and np is not None:
+        return associate_hungarian(lasts, boxes)
+    if np is None or len(lasts) * len(boxes) < 64:  # array setup costs more than a few IoUs
+        return associate_python(lasts, boxes)
+    return associate_numpy(lasts, boxes)
+
 def center_wh(box):
     x1, y1, x2, y2 = box["xmin"], box["ymin"], box["xmax"], box["ymax"]
     cx, cy = (x1 + x2) / 2.0, (y1 + y2) / 2.0
@@ -39,93 +218,229 @@ def ttc_from_heights(h_prev, h_curr, dt):
         return None
     return d_curr / v  # seconds
 
-def lambda_handler(event, _):
-    # S3 trigger on detections_all.jsonl
-    rec = event["Records"][0]["s3"]
-    bucket = rec["bucket"]["name"]
-    key = rec["object"]["key"]  # <video_id>/detections_all.jsonl
-    prefix = key.rsplit("/", 1)[0]
+class TrackStore:
+    """
+    Every track's states as growable typed arrays, found by id in O(1): idx (int64) and
+    cx, cy, w, h, score (float64) per track, with no per-state dicts. JSON is only built by
+    summarize() and to_state(). Frame names are rebuilt from idx through the MediaConvert
+    naming pattern (<stem>.0000042.jpg); names that don't follow it are kept explicitly.
+    """
 
-    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
-    frames = list(parse_jsonl(body))  # [{frame, detections:[{label,score,box:{...}},..]},..]
-    # sort by frame name to maintain order
-    frames.sort(key=lambda f: f["frame"])
+    COLUMNS = ("cx", "cy", "w", "h", "score")
 
-    # Build simple per-frame car boxes
-    seq = []
-    for i, f in enumerate(frames):
-        cars = [d for d in f.get("detections", []) if d.get("label") == "car"]
-        boxes = []
-        for c in cars:
-            b = c.get("box", {})
-            boxes.append({
-                "xmin": float(b.get("xmin", 0)), "ymin": float(b.get("ymin", 0)),
-                "xmax": float(b.get("xmax", 0)), "ymax": float(b.get("ymax", 0)),
-                "score": float(c.get("score", 0.0))
-            })
-        seq.append({"idx": i, "frame": f["frame"], "boxes": boxes})
-
-    # Track with greedy IoU matching
-    tracks = []  # [{id, states:[{idx, frame, box, cx,cy,w,h}], ttc_seconds:..., mean_speed_pxps:...}]
-    next_id = 1
-    active = {}  # track_id -> last(box)
+    def __init__(self, tracks=None, template=None, names=None, done=None):
+        self.tracks = tracks or {}  # track id → (idx, cx, cy, w, h, score) arrays
+        self.template = template    # (head, digits, tail) of the frame names
+        self.names = names or {}    # idx → frame name the template doesn't reproduce
+        self.done = done or {}      # track id → tracks.json entry of a retired track
+        self.checked = None         # idx whose name was last verified
+
+    def __len__(self):
+        return len(self.tracks) + len(self.done)
+
+    def frame_name(self, idx):
+        if idx in self.names or self.template is None:
+            return self.names.get(idx)
+        head, digits, tail = self.template
+        return f"{head}{idx:0{digits}d}{tail}"
+
+    def add(self, tid, idx, frame, box):
+        """Append one state to track `tid` (created on first use)"""
+        cols = self.tracks.get(tid)
+        if cols is None:
+            cols = self.tracks[tid] = (array("q"),) + tuple(array("d") for _ in self.COLUMNS)
+        cx, cy, w, h = center_wh(box)
+        i, x, y, ww, hh, sc = cols
+        i.append(idx); x.append(cx); y.append(cy); ww.append(w); hh.append(h); sc.append(box.get("score", 0.0))
+        if idx != self.checked:  # every box of a step shares the frame
+            self.checked = idx
+            if self.template is None:
+                m = FRAME_NO.search(frame)
+                if m:
+                    self.template = (frame[:m.start(1)], len(m.group(1)), frame[m.end(1):])
+            if self.frame_name(idx) != frame:
+                self.names[idx] = frame
+
+    def state_json(self, cols, k):
+        """
+        tracks.json state k, with the box rebuilt from cx/cy/w/h. That matches the detected box
+        exactly for integer pixel boxes; fractional ones may differ in the last float digits, and
+        a zero-width/height box comes back 1 px wide/high (w/h are clamped to ≥ 1 for TTC).
+        """
+        idx, cx, cy, w, h, score = (col[k] for col in cols)
+        box = {"xmin": cx - w / 2.0, "ymin": cy - h / 2.0, "xmax": cx + w / 2.0, "ymax": cy + h / 2.0, "score": score}
+        return {"idx": idx, "frame": self.frame_name(idx), "box": box, "cx": cx, "cy": cy, "w": w, "h": h}
+
+    def retire(self, tid):
+        """A track that can no longer grow: keep only its tracks.json entry"""
+        cols = self.tracks.pop(tid, None)
+        if cols is not None:
+            self.done[tid] = self.summary(tid, cols)
+
+    def summary(self, tid, cols):
+        """tracks.json entry {id, states:[{idx, frame, box, cx,cy,w,h}], mean_speed_pxps, min_ttc_s}"""
+        idx, cx, cy, _, h, _ = cols
+        speeds = []
+        ttcs = []
+        # compute speeds & TTC (states are stored in frame order)
+        for a, b in zip(range(len(idx)), range(1, len(idx))):
+            dt = (idx[b] - idx[a]) / FPS
+            if dt <= 0: 
+                continue
+            # pixel speed = center displacement / dt
+            dx, dy = (cx[b] - cx[a]), (cy[b] - cy[a])
+            px_speed = math.hypot(dx, dy) / dt  # pixels per second
+            speeds.append(px_speed)
+            # TTC from box height growth (approach)
+            ttc = ttc_from_heights(h[a], h[b], dt)
+            if ttc:
+                ttcs.append(ttc)
+        # keep only first/last frames and a few samples to limit payload
+        states = [self.state_json(cols, k) for k in range(0, len(idx), max(1, len(idx)//10 or 1))]
+        return {"id": tid, "states": states,
+                "mean_speed_pxps": round(sum(speeds)/len(speeds), 2) if speeds else 0.0,
+                "min_ttc_s": round(min(ttcs), 2) if ttcs else None}
+
+    def to_state(self):
+        return {"tracks": {str(tid): [col.tolist() for col in cols] for tid, cols in self.tracks.items()},
+                "template": self.template, "names": {str(k): v for k, v in self.names.items()},
+                "done": list(self.done.values())}
+
+    @classmethod
+    def from_state(cls, data):
+        tracks = {int(tid): (array("q", cols[0]),) + tuple(array("d", c) for c in cols[1:])
+                  for tid, cols in data["tracks"].items()}
+        template = tuple(data["template"]) if data.get("template") else None
+        return cls(tracks, template, {int(k): v for k, v in data.get("names", {}).items()},
+                   {t["id"]: t for t in data.get("done", [])})
+
+def new_state():
+    return {"store": TrackStore(), "active": {}, "next_id": 1, "frames_seen": 0, "last_frame": None, "next_chunk": 0}
+
+def stream_steps(lines, state):
+    """
+    JSONL lines → per-frame car boxes, one step at a time, skipping failed frames.
+    AnalyzeFrames writes frames in key order, so nothing is sorted here; the order is only
+    verified (across chunks too, through state["last_frame"]) and a violation is an error.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        frame, boxes = read_frame(json.loads(line))
+        if state.get("last_frame") is not None and frame <= state["last_frame"]:
+            raise ValueError(f"detections out of frame order: {frame} after {state['last_frame']}")
+        state["last_frame"] = frame
+        i = state["frames_seen"]
+        state["frames_seen"] += 1
+        # (near-duplicate frames skipped by AnalyzeFrames still have a line with the reused detections)
+        if boxes is None:
+            continue  # no model output for this frame: neither evidence of cars nor of their absence
+        yield {"idx": frame_index(frame, i), "frame": frame, "boxes": boxes}
+
+def track(state, seq, assignment=None, engine=None):
+    """Extend the tracks in `state` (updated in place) with the boxes of each step"""
+    if (engine or TRACKER_ENGINE) == "sort" and np is not None:
+        return track_sort(state, seq, assignment)
+    return track_iou(state, seq, assignment)
+
+def track_iou(state, seq, assignment=None):
+    """IoU matching of each step's boxes onto the tracks' last boxes; unmatched tracks retire at once"""
+    store = state["store"]
+    active = state["active"]  # track_id -> last(box)
+    next_id = state["next_id"]
 
     for step in seq:
         assigned = set()
         # try match each active track to best IoU box
-        for tid, last in list(active.items()):
-            best_j, best_iou = None, 0.0
-            for j, b in enumerate(step["boxes"]):
-                if j in assigned: 
-                    continue
-                i = iou(last, b)
-                if i > best_iou:
-                    best_iou, best_j = i, j
-            if best_j is not None and best_iou >= IOU_THRESH:
+        items = list(active.items())
+        for (tid, last), best_j in zip(items, associate([b for _, b in items], step["boxes"], assignment)):
+            if best_j is not None:
                 b = step["boxes"][best_j]
-                cx, cy, w, h = center_wh(b)
-                # append to that track
-                for t in tracks:
-                    if t["id"] == tid:
-                        t["states"].append({"idx": step["idx"], "frame": step["frame"], "box": b, "cx": cx, "cy": cy, "w": w, "h": h})
-                        break
+                store.add(tid, step["idx"], step["frame"], b)
                 active[tid] = b
                 assigned.add(best_j)
             else:
                 # no match → retire track
                 active.pop(tid, None)
+                store.retire(tid)
 
         # any unassigned boxes start new tracks
         for j, b in enumerate(step["boxes"]):
             if j in assigned: 
                 continue
-            cx, cy, w, h = center_wh(b)
-            tracks.append({"id": next_id, "states": [{"idx": step["idx"], "frame": step["frame"], "box": b, "cx": cx, "cy": cy, "w": w, "h": h}]})
+            store.add(next_id, step["idx"], step["frame"], b)
             active[next_id] = b
             next_id += 1
+    state["next_id"] = next_id
 
-    # compute speeds & TTC per track
-    for t in tracks:
-        states = sorted(t["states"], key=lambda s: s["idx"])
-        speeds = []
-        ttcs = []
-        for a, b in zip(states, states[1:]):
-            dt = (b["idx"] - a["idx"]) / FPS
-            if dt <= 0: 
-                continue
-            # pixel speed = center displacement / dt
-            dx, dy = (b["cx"] - a["cx"]), (b["cy"] - a["cy"])
-            px_speed = math.hypot(dx, dy) / dt  # pixels per second
-            speeds.append(px_speed)
-            # TTC from box height growth (approach)
-            ttc = ttc_from_heights(a["h"], b["h"], dt)
-            if ttc:
-                ttcs.append(ttc)
-        t["mean_speed_pxps"] = round(sum(speeds)/len(speeds), 2) if speeds else 0.0
-        t["min_ttc_s"] = round(min(ttcs), 2) if ttcs else None
-        # keep only first/last frames and a few samples to limit payload
-        t["states"] = states[::max(1, len(states)//10 or 1)]
+def track_sort(state, seq, assignment=None):
+    """
+    SORT-style engine. Every live track carries a constant-velocity alpha-beta filter over
+    (cx, cy, w, h), held as one row of the arrays in state["motion"] so prediction and
+    correction run for all tracks at once. Each step matches boxes against the tracks'
+    predicted boxes (same IoU gate and ASSIGNMENT), corrects matched tracks, and retires
+    tracks unmatched for more than MAX_AGE frames; a track coasts through shorter gaps.
+    """
+    store = state["store"]
+    motion = state.setdefault("motion", {"ids": [], "x": [], "v": [], "seen": []})
+    ids = list(motion["ids"])
+    x = np.array(motion["x"], dtype=float).reshape(-1, 4)  # cx, cy, w, h at the last hit
+    v = np.array(motion["v"], dtype=float).reshape(-1, 4)  # per frame
+    seen = np.array(motion["seen"], dtype=float)           # idx of the last hit
+    next_id = state["next_id"]
+    solve = optimal_matches if (assignment or ASSIGNMENT) == "hungarian" else greedy_matches
+
+    for step in seq:
+        dt = step["idx"] - seen
+        pred = x + v * dt[:, None]
+        z = np.array([center_wh(b) for b in step["boxes"]], dtype=float).reshape(-1, 4)
+        matches = [None] * len(ids)
+        if len(ids) and len(z):
+            pred_xyxy = np.hstack([pred[:, :2] - pred[:, 2:] / 2, pred[:, :2] + pred[:, 2:] / 2])
+            z_xyxy = xyxy(step["boxes"])
+            matches = solve(iou_matrix(pred_xyxy, z_xyxy))
+
+        hit = np.array([j is not None for j in matches], dtype=bool)
+        if hit.any():
+            rows = np.nonzero(hit)[0]
+            cols = np.array([matches[r] for r in rows])
+            residual = z[cols] - pred[rows]
+            x[rows] = pred[rows] + SORT_ALPHA * residual
+            v[rows] = v[rows] + SORT_BETA * residual / np.maximum(dt[rows], 1)[:, None]
+            seen[rows] = step["idx"]
+            for r, j in zip(rows, cols):
+                store.add(ids[r], step["idx"], step["frame"], step["boxes"][j])
+
+        # coasting tracks keep their last filter state; too many misses → retire
+        keep = hit | (step["idx"] - seen <= MAX_AGE)
+        for tid, k in zip(ids, keep):
+            if not k:
+                store.retire(tid)
+        ids = [tid for tid, k in zip(ids, keep) if k]
+        x, v, seen = x[keep], v[keep], seen[keep]
+
+        taken = {j for j in matches if j is not None}
+        new = [j for j in range(len(step["boxes"])) if j not in taken]
+        for j in new:
+            store.add(next_id, step["idx"], step["frame"], step["boxes"][j])
+            ids.append(next_id)
+            next_id += 1
+        if new:
+            x = np.vstack([x, z[new]])
+            v = np.vstack([v, np.zeros((len(new), 4))])
+            seen = np.concatenate([seen, np.full(len(new), float(step["idx"]))])
 
+    state["next_id"] = next_id
+    state["motion"] = {"ids": ids, "x": x.tolist(), "v": v.tolist(), "seen": seen.tolist()}
+
+def summarize(store):
+    """Track store → tracks.json entries in track id order (retired tracks are already summarized)"""
+    tracks = dict(store.done)
+    tracks.update((tid, store.summary(tid, cols)) for tid, cols in store.tracks.items())
+    return [tracks[tid] for tid in sorted(tracks)]
+
+def write_tracks(bucket, prefix, tracks):
     out = {
         "video_prefix": prefix,
         "fps": FPS,
@@ -136,4 +451,145 @@ def lambda_handler(event, _):
     out_key = f"{prefix}/tracks.json"
     s3.put_object(Bucket=bucket, Key=out_key, Body=json.dumps(out, indent=2).encode("utf-8"),
                   ContentType="application/json")
-    return {"statusCode": 200, "tracks_uri": f"s3://{bucket}/{out_key}"}
\ No newline at end of file
+    return {"statusCode": 200, "tracks_uri": f"s3://{bucket}/{out_key}"}
+
+def load_state(bucket, prefix):
+    """→ (tracker state, ETag or None)"""
+    try:
+        r = s3.get_object(Bucket=bucket, Key=f"{prefix}/{STATE_NAME}")
+    except ClientError:
+        return new_state(), None
+    state = json.loads(r["Body"].read())
+    state["active"] = {int(k): v for k, v in state["active"].items()}  # JSON object keys are strings
+    state["store"] = TrackStore.from_state(state["store"])
+    return state, r["ETag"]
+
+def save_state(bucket, prefix, state, etag):
+    """Conditional write: False if another invocation advanced the state first"""
+    cond = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        body = json.dumps({**state, "store": state["store"].to_state()}).encode("utf-8")
+        s3.put_object(Bucket=bucket, Key=f"{prefix}/{STATE_NAME}", Body=body,
+                      ContentType="application/json", **cond)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+            return False
+        raise
+
+def open_object(bucket, key):
+    """→ the object's streaming body, or None if it doesn't exist (yet)"""
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)["Body"]
+    except ClientError:
+        return None
+
+def incremental(bucket, prefix):
+    """
+    Consume every chunk that is ready, in sequence order, from the saved state onwards.
+    Chunks can land (and trigger) out of order: a missing chunk just ends this pass, and
+    whoever brings it picks up the rest. Concurrent invocations race on the state's ETag;
+    the loser reloads and continues from where the winner stopped.
+    """
+    while True:
+        state, etag = load_state(bucket, prefix)
+        if state.get("done"):
+            return {"statusCode": 200, "status": "done"}
+        consumed = 0
+        while True:
+            body = open_object(bucket, f"{prefix}/{CHUNK_PREFIX}{state['next_chunk']:06d}.jsonl")
+            if body is None:
+                break
+            track(state, stream_steps(body.iter_lines(chunk_size=LINE_CHUNK_BYTES), state))
+            state["next_chunk"] += 1
+            consumed += 1
+        marker = open_object(bucket, f"{prefix}/{CHUNK_PREFIX}{COMPLETE_NAME}")
+        finished = marker is not None and state["next_chunk"] >= json.loads(marker.read())["chunks"]
+        if not consumed and not finished:
+            return {"statusCode": 200, "status": "waiting", "next_chunk": state["next_chunk"]}
+        if finished:
+            # tracks.json before "done": a failed write or a timeout leaves the state to redo it
+            result = write_tracks(bucket, prefix, summarize(state["store"]))
+            state["done"] = True
+        if not save_state(bucket, prefix, state, etag):
+            continue
+        print(f"➕ Tracked {consumed} chunks ({state['frames_seen']} frames, {len(state['store'])} tracks so far)")
+        if finished:
+            return result
+        return {"statusCode": 200, "status": "tracking", "next_chunk": state["next_chunk"]}
+
+def lambda_handler(event, _):
+    # S3 trigger on detections_all.jsonl (full) or on chunks/* (incremental)
+    rec = event["Records"][0]["s3"]
+    bucket = rec["bucket"]["name"]
+    key = rec["object"]["key"]  # <video_id>/detections_all.jsonl | <video_id>/chunks/000003.jsonl
+    if f"/{CHUNK_PREFIX}" in key:
+        if TRACKER_MODE != "incremental":
+            return {"statusCode": 200, "status": "ignored"}
+        return incremental(bucket, key.split(f"/{CHUNK_PREFIX}", 1)[0])
+    if TRACKER_MODE == "incremental":
+        return {"statusCode": 200, "status": "ignored"}  # the chunks already cover this video
+    prefix = key.rsplit("/", 1)[0]
+
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+
+    # one forward pass over the streamed lines; memory follows the live tracks, not the video
+    state = new_state()
+    track(state, stream_steps(body.iter_lines(chunk_size=LINE_CHUNK_BYTES), state))
+    return write_tracks(bucket, prefix, summarize(state["store"]))
+
+def synthetic_video(n, frames, rng, step_px=6, miss=0.0):
+    """n cars drifting across a 1800×1000 frame → per-frame box lists (shuffled, some missed)"""
+    cars = [[rng.uniform(0, 1800), rng.uniform(0, 1000), rng.uniform(40, 160)] for _ in range(n)]
+    steps = []
+    for _ in range(frames):
+        for c in cars:
+            c[0] += rng.uniform(-step_px, step_px); c[1] += rng.uniform(-step_px / 2, step_px / 2)
+        boxes = [{"xmin": x, "ymin": y, "xmax": x + w, "ymax": y + w * 0.6, "score": 0.9}
+                 for x, y, w in cars if rng.random() >= miss]
+        rng.shuffle(boxes)
+        steps.append(boxes)
+    return steps
+
+def bench(counts=(5, 10, 20, 40, 80), frames=200, seed=7):
+    """Per-frame association time (pure Python, NumPy greedy, Hungarian) and tracks produced, as cars grow"""
+    rng = random.Random(seed)
+    print(f"{'cars':>5} {'python ms':>10} {'numpy ms':>9} {'speedup':>8} {'hungarian ms':>13}")
+    for n in counts:
+        steps = synthetic_video(n, frames, rng)
+        timings = []
+        for fn in (associate_python, associate_numpy, associate_hungarian):
+            t0 = time.perf_counter()
+            for prev, cur in zip(steps, steps[1:]):
+                fn(prev, cur)
+            timings.append((time.perf_counter() - t0) * 1000 / (len(steps) - 1))
+        assert all(associate_python(p, c) == associate_numpy(p, c) for p, c in zip(steps[:20], steps[1:21]))
+        print(f"{n:>5} {timings[0]:>10.3f} {timings[1]:>9.3f} {timings[0] / timings[1]:>7.1f}x {timings[2]:>13.3f}")
+
+    # faster, denser traffic: greedy order effects show up as extra (fragmented) tracks
+    print(f"\n{'cars':>5} {'greedy tracks':>14} {'hungarian tracks':>17}")
+    for n in counts:
+        steps = synthetic_video(n, frames, rng, step_px=30)
+        seq = [{"idx": i, "frame": str(i), "boxes": boxes} for i, boxes in enumerate(steps)]
+        counts_by = []
+        for assignment in ("greedy", "hungarian"):
+            state = new_state()
+            track(state, seq, assignment)
+            counts_by.append(len(state["store"]))
+        print(f"{n:>5} {counts_by[0]:>14} {counts_by[1]:>17}")
+
+    # 10% missed detections: the IoU engine fragments a car at every miss, SORT coasts through
+    print(f"\n{'cars':>5} {'iou tracks':>11} {'sort tracks':>12} {'iou ms':>7} {'sort ms':>8}")
+    for n in counts:
+        steps = synthetic_video(n, frames, rng, step_px=12, miss=0.1)
+        seq = [{"idx": i, "frame": str(i), "boxes": boxes} for i, boxes in enumerate(steps)]
+        row = []
+        for engine in ("iou", "sort"):
+            state = new_state()
+            t0 = time.perf_counter()
+            track(state, seq, engine=engine)
+            row.append((len(state["store"]), (time.perf_counter() - t0) * 1000 / len(seq)))
+        print(f"{n:>5} {row[0][0]:>11} {row[1][0]:>12} {row[0][1]:>7.3f} {row[1][1]:>8.3f}")
+
+if __name__ == "__main__":
+    bench()
@@ -1,12 +1,18 @@
-import boto3, json, os
+import boto3, json, os, re
+from botocore.exceptions import ClientError
 
 # ===== CONFIG =====
 MC_ENDPOINT = "https://mediaconvert.us-east-1.amazonaws.com"
 ROLE_ARN    = "arn:aws:iam::993260645905:role/media"
 BUCKET_OUT  = "crashtruth-frames"
+FRAME_FPS   = 5
+MANIFEST_NAME    = "manifest.json"
+ANALYZE_FUNCTION = os.environ.get("ANALYZE_FUNCTION", "CrashTruth-AnalyzeFrames")
 # ===================
 
 mc = boto3.client("mediaconvert", endpoint_url=MC_ENDPOINT)
+s3 = boto3.client("s3")
+lambda_client = boto3.client("lambda")
 
 def lambda_handler(event, context):
     print("Received event:", json.dumps(event))
@@ -30,6 +36,8 @@ def lambda_handler(event, context):
     # job settings
     job = {
       "Role": ROLE_ARN,
+      # echoed back in the job-state-change event → completion_handler
+      "UserMetadata": {"video_id": base, "fps": str(FRAME_FPS)},
       "Settings": {
         "Inputs": [{"FileInput": f"s3://{bucket}/{key}"}],
         "OutputGroups": [
@@ -67,7 +75,7 @@ def lambda_handler(event, context):
                 "CodecSettings": {
                   "Codec": "FRAME_CAPTURE",
                   "FrameCaptureSettings": {
-                    "FramerateNumerator": 5,
+                    "FramerateNumerator": FRAME_FPS,
                     "FramerateDenominator": 1,
                     "Quality": 80
                   }
@@ -85,3 +93,73 @@ def lambda_handler(event, context):
     print(f"✅ Frame extraction started for {filename} → JobID: {job_id}")
 
     return {"status": "started", "jobId": job_id, "video": filename}
+
+
+def frame_manifest(detail):
+    """
+    Build the per-video frame manifest from a COMPLETE job event.
+    Frame capture reports only its last file (<base>.0000123.jpg); frames are numbered
+    from 0 without gaps, so the full key list follows from that one path.
+    """
+    meta = detail.get("userMetadata", {})
+    for group in detail.get("outputGroupDetails", []):
+        for out in group.get("outputDetails", []):
+            for path in out.get("outputFilePaths", []):
+                m = re.match(r"s3://([^/]+)/(.+)\.(\d+)\.jpg$", path)
+                if not m:
+                    continue
+                bucket, stem, last = m.group(1), m.group(2), m.group(3)
+                video_id = meta.get("video_id") or stem.split("/")[0]
+                count = int(last) + 1
+                video = out.get("videoDetails", {})
+                return {
+                    "video_id": video_id,
+                    "job_id": detail.get("jobId"),
+                    "bucket": bucket,
+                    "fps": float(meta.get("fps", FRAME_FPS)),
+                    "width": video.get("widthInPx"),
+                    "height": video.get("heightInPx"),
+                    "duration_ms": out.get("durationInMs"),
+                    "count": count,
+                    "frames": [f"{stem}.{i:0{len(last)}d}.jpg" for i in range(count)]
+                }
+    return None
+
+def completion_handler(event, context):
+    """EventBridge target for "MediaConvert Job State Change" → frame manifest + one AnalyzeFrames run"""
+    print("Received event:", json.dumps(event))
+    detail = event.get("detail", {})
+
+    if detail.get("status") != "COMPLETE":
+        print(f"Job {detail.get('jobId')} is {detail.get('status')}. Skipping.")
+        return {"status": "skipped"}
+
+    manifest = frame_manifest(detail)
+    if not manifest:
+        print(f"❌ No frame capture output in job {detail.get('jobId')}")
+        return {"status": "error", "error": "no frame capture output"}
+
+    key = f"{manifest['video_id']}/{MANIFEST_NAME}"
+    duplicate = False
+    try:
+        # conditional create: a redelivered event finds the first manifest and keeps it
+        s3.put_object(Bucket=manifest["bucket"], Key=key,
+                      Body=json.dumps(manifest).encode("utf-8"),
+                      ContentType="application/json", IfNoneMatch="*")
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("PreconditionFailed", "ConditionalRequestConflict"):
+            raise
+        # still dispatch: the first delivery may have failed to invoke after writing the manifest,
+        # and AnalyzeFrames' claim turns any extra run into a no-op
+        print(f"Manifest s3://{manifest['bucket']}/{key} already exists. Dispatching again.")
+        duplicate = True
+
+    lambda_client.invoke(
+        FunctionName=ANALYZE_FUNCTION,
+        InvocationType="Event",
+        Payload=json.dumps({"manifest": {"bucket": manifest["bucket"], "key": key}}).encode("utf-8")
+    )
+    print(f"✅ {manifest['count']} frames for {manifest['video_id']} → {ANALYZE_FUNCTION}")
+
+    return {"status": "duplicate" if duplicate else "dispatched", "manifest": f"s3://{manifest['bucket']}/{key}",
+            "frames": manifest["count"]}
@@ -0,0 +1,146 @@
+"""
+Streaming S3 writers shared by the CrashTruth Lambdas. No clients or configuration are
+created at import time beyond the part size, so any function can bundle this file next to
+its handler and import it.
+"""
+import os, uuid
+
+# S3 multipart parts must be ≥ 5 MiB (except the last one)
+PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get("PART_SIZE_BYTES", str(8 * 1024 * 1024))))
+INDEX_ENTRY_BYTES = 22  # "<offset:012d> <length:08d>\n" per frame in a .idx sidecar
+
+class S3MultipartWriter:
+    """
+    Streams an artifact to S3 through multipart upload parts instead of one big put_object.
+    Memory stays bounded by part_size no matter how much is written. The writer state
+    (upload id, finished parts, keys of the unflushed tail) is JSON-serializable, so an upload
+    can be checkpointed and continued by a later invocation. The tail itself is not part of
+    the state: each state() call stores only the bytes added since the last one as a small
+    <key>.pending/<id> segment object, so checkpoints stay small and each byte is saved about
+    once. Outputs smaller than one part are written with a plain put_object on close().
+    """
+
+    def __init__(self, client, bucket: str, key: str, content_type="application/json",
+                 part_size=PART_SIZE, state=None):
+        self.client, self.bucket, self.key = client, bucket, key
+        self.content_type, self.part_size = content_type, part_size
+        state = state or {}
+        self.upload_id = state.get("upload_id")
+        self.parts = state.get("parts", [])
+        self.bytes_written = state.get("bytes_written", 0)
+        self.segments = state.get("segments", [])
+        self.closed = state.get("closed", False)
+        self.buffer = bytearray(state.get("pending", "").encode("utf-8"))  # older checkpoints kept the tail inline
+        for segment in self.segments:
+            self.buffer += client.get_object(Bucket=bucket, Key=segment)["Body"].read()
+        self.saved = len(self.buffer) if self.segments else 0  # buffer bytes already in segments
+
+    def state(self):
+        if len(self.buffer) > self.saved:
+            segment = f"{self.key}.pending/{uuid.uuid4().hex}"  # never overwrite one a checkpoint may name
+            self.client.put_object(Bucket=self.bucket, Key=segment, Body=bytes(self.buffer[self.saved:]))
+            self.segments.append(segment)
+            self.saved = len(self.buffer)
+        return {"upload_id": self.upload_id, "parts": self.parts, "bytes_written": self.bytes_written,
+                "segments": list(self.segments), "closed": self.closed}
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+            self.segments, self.saved = [], 0  # the leftover is saved afresh by the next state()
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.write(line.encode("utf-8") + b"\n")
+
+    def _upload_part(self, data: bytes):
+        self.parts.append(self._put_part(len(self.parts) + 1, data))
+
+    def _put_part(self, number: int, data: bytes):
+        if not self.upload_id:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type)["UploadId"]
+        r = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                    PartNumber=number, Body=data)
+        return {"PartNumber": number, "ETag": r["ETag"]}
+
+    def close(self):
+        """
+        Finish the object. The state only changes once S3 has accepted it, so a failed close can
+        be retried from the same state, and closing an already closed writer does nothing.
+        """
+        if self.closed:
+            return
+        if not self.upload_id:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer),
+                                   ContentType=self.content_type)
+        else:
+            parts = self.parts + ([self._put_part(len(self.parts) + 1, bytes(self.buffer))] if self.buffer else [])
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={"Parts": parts})
+            self.parts = parts
+        self.buffer, self.closed = bytearray(), True
+        self._drop_segments()
+
+    def abort(self):
+        if self.upload_id:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.upload_id, self.parts, self.buffer = None, [], bytearray()
+        self._drop_segments()
+
+    def _drop_segments(self):
+        """Delete every tail segment, including ones superseded by earlier part uploads"""
+        pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=f"{self.key}.pending/")
+        for page in pages:
+            keys = [{"Key": o["Key"]} for o in page.get("Contents", [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True})
+        self.segments, self.saved = [], 0
+
+def index_key(report_key: str):
+    """detections_all.jsonl → detections_all.idx"""
+    return report_key.rsplit(".", 1)[0] + ".idx"
+
+class IndexedJSONLWriter:
+    """
+    A JSONL report plus its index sidecar, both streamed through S3MultipartWriter. Line i of
+    the index is "<byte offset:012d> <length:08d>\n" for line i of the report (length without
+    the newline), so frame i's entry sits at byte i * INDEX_ENTRY_BYTES and any window of
+    frames costs two ranged GETs (see read_frames).
+    """
+
+    def __init__(self, client, bucket: str, key: str, state=None):
+        state = state or {}
+        self.report = S3MultipartWriter(client, bucket, key, state=state.get("report"))
+        self.index = S3MultipartWriter(client, bucket, index_key(key), content_type="text/plain",
+                                       state=state.get("index"))
+
+    @property
+    def bytes_written(self):
+        return self.report.bytes_written
+
+    @property
+    def parts(self):
+        return self.report.parts
+
+    def state(self):
+        return {"report": self.report.state(), "index": self.index.state()}
+
+    def write_lines(self, lines):
+        entries = []
+        for line in lines:
+            data = line.encode("utf-8")
+            entries.append(f"{self.report.bytes_written:012d} {len(data):08d}\n")
+            self.report.write(data + b"\n")
+        self.index.write("".join(entries).encode("utf-8"))
+
+    def close(self):
+        self.report.close()
+        self.index.close()
+
+    def abort(self):
+        self.report.abort()
+        self.index.abort()
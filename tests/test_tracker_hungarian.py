@@ -0,0 +1,82 @@
+import os, itertools, importlib.util
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")  # the tracker creates its S3 client at import
+
+spec = importlib.util.spec_from_file_location("tracker", Path(__file__).resolve().parent.parent / "CrashTruth-Tracker.py")
+tracker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tracker)
+
+
+def brute_force(cost):
+    """Lowest total cost over every assignment of min(n, m) rows to distinct columns"""
+    n, m = cost.shape
+    k = min(n, m)
+    return min(sum(cost[r, c] for r, c in zip(rows, cols))
+               for rows in itertools.permutations(range(n), k)
+               for cols in itertools.permutations(range(m), k))
+
+
+def check_assignment(cost, rows, cols):
+    n, m = cost.shape
+    assert len(rows) == len(cols) == min(n, m)
+    assert len(set(rows.tolist())) == len(rows) and len(set(cols.tolist())) == len(cols)
+    assert list(rows) == sorted(rows)
+
+
+def random_costs(seed, count=200):
+    rng = np.random.default_rng(seed)
+    for trial in range(count):
+        n, m = map(int, rng.integers(1, 6, 2))
+        cost = rng.random((n, m))
+        if trial % 3 == 0:
+            cost = np.round(cost * 3)  # plenty of ties
+        yield cost
+
+
+def test_hungarian_matches_brute_force():
+    for cost in random_costs(0):
+        rows, cols = tracker.hungarian(cost)
+        check_assignment(cost, rows, cols)
+        assert cost[rows, cols].sum() == pytest.approx(brute_force(cost))
+
+
+def test_hungarian_matches_scipy():
+    optimize = pytest.importorskip("scipy.optimize")
+    for cost in random_costs(1):
+        rows, cols = tracker.hungarian(cost)
+        r, c = optimize.linear_sum_assignment(cost)
+        assert cost[rows, cols].sum() == pytest.approx(cost[r, c].sum())
+
+
+def test_gated_costs(monkeypatch):
+    """optimal_matches' 1e6 gate: as many allowed pairs as possible, then the highest total IoU"""
+    monkeypatch.setattr(tracker, "linear_sum_assignment", None)  # exercise hungarian()
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        n, m = map(int, rng.integers(1, 5, 2))
+        iou = rng.random((n, m)) * (rng.random((n, m)) < 0.6)  # ~40% of pairs don't overlap at all
+        allowed = (iou > 0.0) & (iou >= tracker.IOU_THRESH)
+        cost = np.where(allowed, 1.0 - iou, 1e6)
+        rows, cols = tracker.hungarian(cost)
+        check_assignment(cost, rows, cols)
+        assert cost[rows, cols].sum() == pytest.approx(brute_force(cost))
+
+        matches = tracker.optimal_matches(iou)
+        pairs = [(r, c) for r, c in enumerate(matches) if c is not None]
+        assert all(allowed[r, c] for r, c in pairs)
+        assert len({c for _, c in pairs}) == len(pairs)
+        best = brute_force(cost)
+        gated = int(best // 1e6)
+        assert len(pairs) == min(n, m) - gated
+        assert sum(iou[r, c] for r, c in pairs) == pytest.approx(len(pairs) - (best - gated * 1e6))
+
+
+def test_hungarian_beats_greedy():
+    # greedy gives track 0 its best box (0) and leaves track 1 with nothing above the gate
+    iou = np.array([[0.9, 0.8],
+                    [0.85, 0.1]])
+    assert tracker.greedy_matches(iou) == [0, None]
+    assert tracker.optimal_matches(iou) == [1, 0]